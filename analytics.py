@@ -0,0 +1,148 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import storage
+
+"""
+Delay analytics over the stop-time history of the station table. The history is loaded in bulk
+into a pandas frame (a single COPY TO for PostgreSQL), and every statistic is a vectorized
+group-by over it: distribution of the delays, delay per station and hour of the day, worst
+stations, and delay gained or recovered between consecutive stops of the trips.
+Usage: python analytics.py export [folder] [start epoch] [end epoch]
+"""
+
+COLUMNS = list(storage.HISTORY_COLUMNS)
+DTYPES = {"trip": "int64", "stopId": "Int32", "nameStation": "category", "arrivalTime": "int64", "delay": "int32"}
+TIMEZONE = "Europe/Brussels"
+EXPORT_PATH = "analytics/"
+# Bounds of the delay histogram, in minutes
+DELAY_BINS = [-60, -5, -1, 0, 1, 3, 5, 10, 15, 30, 60, 1440]
+
+
+def loadHistory(epochStart=None, epochEnd=None):
+    """
+    Loads the stops of the station table between two times in one bulk read, see
+    storage.StorageBackend.copyHistory
+    :return: frame of COLUMNS, ordered by trip and time
+    """
+    buffer = io.StringIO()
+    storage.getBackend().copyHistory(buffer, epochStart, epochEnd)
+    buffer.seek(0)
+    return pd.read_csv(buffer, header=0, names=COLUMNS, dtype=DTYPES)
+
+
+def localHours(frame):
+    return pd.to_datetime(frame["arrivalTime"], unit="s", utc=True).dt.tz_convert(TIMEZONE).dt.hour
+
+
+def delayDistribution(frame, bins=DELAY_BINS):
+    """
+    :return: frame of the number and share of stops in each delay interval, in minutes
+    """
+    counts, edges = np.histogram(frame["delay"].to_numpy() / 60, bins=bins)
+    total = max(counts.sum(), 1)
+    return pd.DataFrame({"fromMinutes": edges[:-1], "toMinutes": edges[1:], "stops": counts,
+                         "share": counts / total})
+
+
+def stationHourStats(frame):
+    """
+    :return: frame of the number of stops, mean, median, 90th percentile and maximum delay in
+    seconds, per station and local hour of the day
+    """
+    grouped = frame.assign(hour=localHours(frame)).groupby(["nameStation", "hour"], observed=True)["delay"]
+    stats = grouped.agg(stops="count", mean="mean", max="max")
+    # Without stops, the unstacked quantiles have no column
+    quantiles = grouped.quantile([0.5, 0.9]).unstack().reindex(columns=[0.5, 0.9])
+    quantiles.columns = ["p50", "p90"]
+    return stats.join(quantiles)[["stops", "mean", "p50", "p90", "max"]].reset_index()
+
+
+def hourProfile(frame):
+    """
+    :return: frame of the number of stops, mean and 90th percentile delay in seconds per local hour
+    """
+    grouped = frame.assign(hour=localHours(frame)).groupby("hour")["delay"]
+    return grouped.agg(stops="count", mean="mean", p90=lambda delays: delays.quantile(0.9)).reset_index()
+
+
+def worstStations(frame, count=20, minStops=10):
+    """
+    :param minStops: stations with fewer stops are left out
+    :return: frame of the stations with the highest mean delay
+    """
+    stats = frame.groupby("nameStation", observed=True)["delay"].agg(stops="count", mean="mean", max="max")
+    stats = stats[stats["stops"] >= minStops]
+    return stats.sort_values("mean", ascending=False).head(count).reset_index()
+
+
+def delayPropagation(frame):
+    """
+    Delay gained between each stop of a trip and the next one, per pair of consecutive stations:
+    a positive mean means trains lose time on this section, a negative one that they catch up
+    :return: frame of the number of runs, mean delay at departure, mean and maximum delay gained,
+    and share of the runs gaining delay, ordered by decreasing mean gain
+    """
+    ordered = frame.sort_values(["trip", "arrivalTime"])
+    sameTrip = ordered["trip"].to_numpy()[1:] == ordered["trip"].to_numpy()[:-1]
+    delays = ordered["delay"].to_numpy()
+    names = ordered["nameStation"].astype(str).to_numpy()
+    sections = pd.DataFrame({
+        "fromStation": names[:-1][sameTrip],
+        "toStation": names[1:][sameTrip],
+        "departureDelay": delays[:-1][sameTrip],
+        "gained": (delays[1:] - delays[:-1])[sameTrip],
+    })
+    grouped = sections.groupby(["fromStation", "toStation"])
+    stats = grouped.agg(runs=("gained", "count"), departureDelay=("departureDelay", "mean"),
+                        meanGained=("gained", "mean"), maxGained=("gained", "max"),
+                        gainingShare=("gained", lambda gained: (gained > 0).mean()))
+    return stats.sort_values("meanGained", ascending=False).reset_index()
+
+
+def summary(frame):
+    """
+    :return: dictionary of every statistic of the module, by name
+    """
+    return {
+        "distribution": delayDistribution(frame),
+        "stationHour": stationHourStats(frame),
+        "hourProfile": hourProfile(frame),
+        "worstStations": worstStations(frame),
+        "propagation": delayPropagation(frame),
+    }
+
+
+def exportResults(results, folder=EXPORT_PATH):
+    """
+    Writes each statistic as a csv file, and as a Parquet file when pyarrow is installed
+    :return: the list of written files
+    """
+    os.makedirs(folder, exist_ok=True)
+    written = []
+    for name, table in results.items():
+        path = os.path.join(folder, name + ".csv")
+        table.to_csv(path, index=False)
+        written.append(path)
+        try:
+            table.to_parquet(os.path.join(folder, name + ".parquet"), index=False)
+            written.append(os.path.join(folder, name + ".parquet"))
+        except ImportError:
+            pass
+    return written
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        print("usage: python analytics.py export [folder] [start epoch] [end epoch]")
+        sys.exit(1)
+    folder = sys.argv[2] if len(sys.argv) > 2 else EXPORT_PATH
+    bounds = [int(value) for value in sys.argv[3:5]]
+    history = loadHistory(*bounds)
+    print(f"{len(history)} stops loaded")
+    for file in exportResults(summary(history), folder):
+        print(file)
@@ -0,0 +1,178 @@
+import os
+import shutil
+import sys
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import common
+import db
+import stations
+
+"""
+Columnar archive of the decoded stop-time updates, stored as Parquet files partitioned by
+service date (service_date=YYYYMMDD/ folders). It is an offline alternative to the station
+table: the archived feeds are decoded once, and the delay aggregates and trip lookups below run
+as vectorized Arrow scans that only read the partitions they need.
+Usage:
+    python archive.py export [workers]
+    python archive.py compact
+"""
+
+ARCHIVE_PATH = "archive/"
+# Names of the exported gtfsrt files, one per line. The leading underscore keeps it out of the dataset.
+LEDGER = "_exported.txt"
+
+SCHEMA = pa.schema([
+    ("stop_id", pa.int32()),
+    ("epoch", pa.int64()),
+    ("delay", pa.int32()),
+    ("trip_id", pa.string()),
+    ("service_date", pa.string()),
+])
+PARTITIONING = ds.partitioning(pa.schema([("service_date", pa.string())]), flavor="hive")
+
+
+def decodeFile(url):
+    """
+    Decodes a gtfsrt file into a table following SCHEMA
+    """
+    columns = {name: [] for name in SCHEMA.names}
+    for stopTimes in common.extractStopTimes(url):
+        for stopId, epoch, delay, (tripId, startDate) in stopTimes:
+            if not stopId.isdigit():
+                continue
+            columns["stop_id"].append(int(stopId))
+            columns["epoch"].append(epoch)
+            columns["delay"].append(delay)
+            columns["trip_id"].append(tripId)
+            columns["service_date"].append(startDate)
+    return pa.table(columns, schema=SCHEMA)
+
+
+def exportArchive(root=ARCHIVE_PATH, files=None, workers=1):
+    """
+    Decodes gtfsrt files of the data folder into the archive. Each file is written as its own
+    Parquet part in the partitions it covers, so exporting new files does not rewrite the
+    archive; see compactArchive. The files already exported, listed in the LEDGER of the
+    archive, are skipped.
+    :param files: names of the files to export, defaults to every gtfsrt file of the data folder
+    :param workers: number of decoding processes
+    :return: the number of exported rows
+    """
+    dataPath = "data/"
+    if files is None:
+        files = db.listGtfsFiles(dataPath)
+    exported = exportedFiles(root)
+    files = [file for file in files if file not in exported]
+    os.makedirs(root, exist_ok=True)
+    urls = ['file://' + os.path.join(os.getcwd(), dataPath + file) for file in files]
+    rows = 0
+    decoded = db.decodeInOrder(decodeFile, urls, workers)
+    try:
+        for file, table in zip(files, decoded):
+            ds.write_dataset(table, root, format="parquet", partitioning=PARTITIONING,
+                             existing_data_behavior="overwrite_or_ignore",
+                             basename_template=os.path.splitext(file)[0] + "-{i}.parquet")
+            with open(os.path.join(root, LEDGER), 'a', encoding='utf-8') as f:
+                f.write(file + "\n")
+            rows += table.num_rows
+    finally:
+        decoded.close()
+    return rows
+
+
+def exportedFiles(root=ARCHIVE_PATH):
+    """
+    :return: the set of the gtfsrt files already exported into the archive
+    """
+    try:
+        with open(os.path.join(root, LEDGER), encoding='utf-8') as f:
+            return {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def compactArchive(root=ARCHIVE_PATH):
+    """
+    Rewrites each partition of the archive as a single Parquet file sorted by trip and time
+    """
+    for partition in sorted(os.listdir(root)):
+        path = os.path.join(root, partition)
+        if not partition.startswith("service_date=") or len(os.listdir(path)) <= 1:
+            continue
+        table = ds.dataset(path, format="parquet").to_table().sort_by([("trip_id", "ascending"),
+                                                                       ("epoch", "ascending")])
+        compacted = path + ".compacted"
+        os.makedirs(compacted, exist_ok=True)
+        pq.write_table(table, os.path.join(compacted, "part-0.parquet"))
+        shutil.rmtree(path)
+        os.rename(compacted, path)
+
+
+def openArchive(root=ARCHIVE_PATH):
+    return ds.dataset(root, format="parquet", partitioning=PARTITIONING, schema=SCHEMA)
+
+
+def stationNames(stopIds):
+    """
+    :return: the names of the stations of a list of stop IDs
+    """
+    index = stations.loadStationIndex()
+    return [index.names[index.positions[str(stopId)]] if str(stopId) in index.positions else str(stopId)
+            for stopId in stopIds]
+
+
+def retrievePath(tripId, serviceDate, root=ARCHIVE_PATH):
+    """
+    Same as db.retrievePath for a trip of the archive
+    :return: the table of the stops of the trip ordered by time, with their station name
+    """
+    table = openArchive(root).to_table(
+        filter=(pc.field("service_date") == serviceDate) & (pc.field("trip_id") == tripId))
+    table = table.sort_by("epoch")
+    return table.append_column("nameStation", pa.array(stationNames(table["stop_id"].to_pylist())))
+
+
+def retrieveMean(tripId, epochStart, epochEnd, serviceDate=None, root=ARCHIVE_PATH):
+    """
+    Same as db.retrieveMean for a trip of the archive: mean delay in minutes of each station,
+    ordered by mean time
+    :param serviceDate: when given, only this partition is read
+    :return: list of (nameStation, mean delay)
+    """
+    condition = (pc.field("trip_id") == tripId) & (pc.field("epoch") > epochStart) & (pc.field("epoch") < epochEnd)
+    if serviceDate is not None:
+        condition = condition & (pc.field("service_date") == serviceDate)
+    table = openArchive(root).to_table(columns=["stop_id", "epoch", "delay"], filter=condition)
+    grouped = table.group_by("stop_id").aggregate([("delay", "mean"), ("epoch", "mean")])
+    grouped = grouped.sort_by("epoch_mean")
+    names = stationNames(grouped["stop_id"].to_pylist())
+    means = pc.round(pc.divide(grouped["delay_mean"], 60)).to_pylist()
+    return list(zip(names, [int(mean) for mean in means]))
+
+
+def meanDelayByStation(epochStart, epochEnd, root=ARCHIVE_PATH):
+    """
+    Delay statistics of every station between two times, over all the trips of the archive
+    :return: table of stop_id, nameStation, number of stops, mean and max delay in seconds,
+    ordered by decreasing mean delay
+    """
+    condition = (pc.field("epoch") >= epochStart) & (pc.field("epoch") < epochEnd)
+    table = openArchive(root).to_table(columns=["stop_id", "delay"], filter=condition)
+    grouped = table.group_by("stop_id").aggregate([("delay", "count"), ("delay", "mean"), ("delay", "max")])
+    grouped = grouped.sort_by([("delay_mean", "descending")])
+    return grouped.append_column("nameStation", pa.array(stationNames(grouped["stop_id"].to_pylist())))
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "export":
+        print(f"{exportArchive(workers=int(sys.argv[2]) if len(sys.argv) > 2 else 1)} rows exported")
+    elif command == "compact":
+        compactArchive()
+    else:
+        print("usage: python archive.py export [workers] | compact")
+        sys.exit(1)
@@ -0,0 +1,331 @@
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import osmnx as ox
+
+import common
+import db
+import graphcache
+import osm
+import routing
+import storage
+import trainindex
+
+"""
+Benchmarks of the ingestion and visualization pipeline.
+Usage: python benchmark.py <name> [arguments]
+The database benchmarks drop and recreate the station table of the configured database.
+"""
+
+
+def benchIngest(fileCount=15):
+    """
+    Compares the per-row INSERT path with the bulk COPY and execute_values paths on the same files
+    :param fileCount: number of gtfsrt files to import for each mode
+    """
+    files = sorted(f for f in os.listdir("data/") if f.endswith(".gtfsrt"))[:int(fileCount)]
+    conn, cur = db.connectToDB()
+    results = {}
+    for label, bulk, method in (("per-row", False, "copy"), ("copy", True, "copy"), ("values", True, "values")):
+        db.createTable(cur)
+        conn.commit()
+        print(f"--- {label}")
+        results[label] = db.importGtfsData(conn, cur, bulk=bulk, method=method, files=files)
+    cur.close()
+    conn.close()
+
+    print("--- summary")
+    baseRows, baseTime = results["per-row"]
+    for label, (rows, seconds) in results.items():
+        speedup = baseTime / seconds if seconds > 0 else 0
+        print(f"{label.ljust(10)} {rows} rows  {seconds:.2f}s  x{speedup:.1f}")
+
+
+def dictStopTimes(url):
+    """
+    Former extraction route: builds the whole dictionary with MessageToDict before walking it
+    """
+    gtfsDict = common.preprocessing(url)
+    for entity in gtfsDict.get('entity', []):
+        if 'tripUpdate' not in entity:
+            continue
+        trip = entity['tripUpdate']['trip']
+        tripKey = (trip.get('tripId', ''), trip.get('startDate', ''))
+        stops = entity['tripUpdate'].get('stopTimeUpdate', [])
+        stopTimes = []
+        departure = None
+        for i, stop in enumerate(stops):
+            if i == len(stops) - 1:
+                stopTimes.append((stop['stopId'], int(stop['arrival']['time']), stop['arrival'].get('delay', 0),
+                                  tripKey))
+            else:
+                if 'departure' in stop:
+                    departure = (int(stop['departure'].get('time', 0)), stop['departure'].get('delay', 0))
+                if departure is not None:
+                    stopTimes.append((stop['stopId'], departure[0], departure[1], tripKey))
+        yield stopTimes
+
+
+def measure(extract, url):
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = sum(len(stopTimes) for stopTimes in extract(url))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, elapsed, peak
+
+
+def benchDecode(fileCount=20):
+    """
+    Compares, per feed, the MessageToDict route with the direct protobuf walk of
+    common.extractStopTimes: time and peak memory allocated while extracting the stop times
+    :param fileCount: number of gtfsrt files to decode
+    """
+    files = db.listGtfsFiles()[:int(fileCount)]
+    urls = ['file://' + os.path.join(os.getcwd(), "data/" + file) for file in files]
+    totals = {"dict": [0, 0.0, 0], "direct": [0, 0.0, 0]}
+    for url in urls:
+        for label, extract in (("dict", dictStopTimes), ("direct", common.extractStopTimes)):
+            rows, elapsed, peak = measure(extract, url)
+            totals[label][0] += rows
+            totals[label][1] += elapsed
+            totals[label][2] = max(totals[label][2], peak)
+
+    print(f"{len(urls)} feeds")
+    for label, (rows, elapsed, peak) in totals.items():
+        perFeed = elapsed / len(urls) * 1000 if urls else 0
+        print(f"{label.ljust(8)} {rows} stop times  {perFeed:.1f} ms/feed  peak {peak / 1024:.0f} KiB")
+
+
+def benchBackends(fileCount=15, queries=200):
+    """
+    Loads the same files into every storage backend, then times the dashboard queries on each of
+    them with the same stations and times
+    :param fileCount: number of gtfsrt files to load
+    :param queries: number of trip searches
+    """
+    files = db.listGtfsFiles()[:int(fileCount)]
+    backends = {"postgres": storage.PostgresBackend(), "sqlite": storage.SqliteBackend()}
+    for label, backend in backends.items():
+        print(f"--- {label}")
+        storage.loadInto(backend, files)
+
+    # Departure, arrival and time of real stops, so that the searches find trips
+    sample = backends["sqlite"].query("select d.nameStation, a.nameStation, d.arrivalTime - 60 "
+                                      "from station d JOIN station a ON a.trip = d.trip "
+                                      "AND a.arrivalTime > d.arrivalTime ORDER BY random() LIMIT ?",
+                                      (int(queries),))
+    print("--- queries")
+    for label, backend in backends.items():
+        start = time.perf_counter()
+        for departure, arrival, epoch in sample:
+            trips = backend.findTrips(departure, arrival, epoch, limit=1)
+            if trips:
+                backend.retrieveMean(trips[0][0][5], epoch - 86400, epoch + 86400)
+        elapsed = time.perf_counter() - start
+        perQuery = elapsed / len(sample) * 1000 if sample else 0
+        print(f"{label.ljust(10)} {len(sample)} searches  {perQuery:.2f} ms/search")
+        backend.close()
+
+
+def networkxRoute(G, node1, node2):
+    """
+    Former routing path: NetworkX Dijkstra over the osmnx graph, one pair of stations at a time
+    """
+    route = ox.shortest_path(G, node1, node2) or []
+    return np.array([(G.nodes[node]['y'], G.nodes[node]['x']) for node in route], dtype=np.float64).reshape(-1, 2)
+
+
+def routeLength(routeNodes):
+    return float(osm.segmentLengths(routeNodes).sum()) if len(routeNodes) > 1 else 0.0
+
+
+def benchRouting(tripCount=20):
+    """
+    Routes the consecutive stations of real trips of the station table with NetworkX, one pair at
+    a time, then with the CSR routing engine, one batch per trip, without the route cache
+    :param tripCount: number of trips
+    """
+    G = osm.loadGraph()
+    conn, cur = db.connectToDB()
+    cur.execute("SELECT trip FROM (SELECT DISTINCT trip FROM station) t ORDER BY random() LIMIT %s", (int(tripCount),))
+    trips = [db.retrievePath(trip) for trip, in cur.fetchall()]
+    cur.close()
+    conn.close()
+    tripPairs = [[(osm.snapStation(G, trip[i]), osm.snapStation(G, trip[i + 1])) for i in range(len(trip) - 1)]
+                 for trip in trips]
+    pairCount = sum(len(pairs) for pairs in tripPairs)
+
+    start = time.perf_counter()
+    engine = routing.RoutingEngine(graphcache.railGraphOf(G))
+    print(f"engine built in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    expected = [[networkxRoute(G, node1, node2) for node1, node2 in pairs] for pairs in tripPairs]
+    networkxTime = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [engine.routes(pairs) for pairs in tripPairs]
+    engineTime = time.perf_counter() - start
+
+    # Both are shortest paths, their lengths must match even when they pick different nodes
+    differences = [abs(routeLength(a) - routeLength(b)) for routesA, routesB in zip(expected, found)
+                   for a, b in zip(routesA, routesB)]
+    print(f"{len(trips)} trips  {pairCount} station pairs")
+    for label, elapsed in (("networkx", networkxTime), ("csr", engineTime)):
+        perTrip = elapsed / len(trips) * 1000 if trips else 0
+        print(f"{label.ljust(10)} {elapsed:.2f}s  {perTrip:.1f} ms/trip  x{networkxTime / elapsed if elapsed > 0 else 0:.1f}")
+    print(f"largest route length difference {max(differences, default=0):.1f} m")
+
+
+async def loadTest(paths, concurrency):
+    """
+    Sends the requests to an in-process service with concurrent clients
+    :return: the latency of each request in seconds, the total time and the service
+    """
+    import aiohttp
+    from aiohttp import web
+
+    import service
+
+    app = service.createApp()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    latencies = []
+    queue = asyncio.Queue()
+    for path in paths:
+        queue.put_nowait(path)
+
+    async def client(session):
+        while not queue.empty():
+            path = queue.get_nowait()
+            start = time.perf_counter()
+            async with session.get("http://127.0.0.1:%d%s" % (port, path)) as response:
+                await response.read()
+                if response.status != 200:
+                    print(f"{path}: HTTP {response.status}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    try:
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*(client(session) for _ in range(int(concurrency))))
+        elapsed = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+    return latencies, elapsed, app
+
+
+def benchService(requests=500, concurrency=20, searches=50):
+    """
+    Load test of the HTTP service: concurrent clients ask for trips, delay statistics and
+    trajectories of real stations, each search being asked several times to exercise the cache
+    :param requests: total number of requests
+    :param concurrency: number of concurrent clients
+    :param searches: number of distinct searches
+    """
+    from urllib.parse import urlencode
+
+    conn, cur = db.connectToDB()
+    cur.execute("SELECT d.nameStation, a.nameStation, d.arrivalTime - 60 FROM station d "
+                "JOIN station a ON a.trip = d.trip AND a.arrivalTime > d.arrivalTime "
+                "ORDER BY random() LIMIT %s", (int(searches),))
+    sample = cur.fetchall()
+    cur.close()
+    conn.close()
+    if not sample:
+        print("the station table is empty")
+        return
+    paths = []
+    for _ in range(int(requests)):
+        departure, arrival, epoch = random.choice(sample)
+        endpoint = random.choice(("/trips", "/delays", "/trajectory"))
+        paths.append(endpoint + "?" + urlencode({"from": departure, "to": arrival, "time": epoch}))
+
+    latencies, elapsed, app = asyncio.run(loadTest(paths, concurrency))
+    latencies.sort()
+    cache = app["cache"]
+    print(f"{len(latencies)} requests  {int(concurrency)} clients  {len(latencies) / elapsed:.0f} requests/s")
+    print(f"latency p50 {latencies[len(latencies) // 2] * 1000:.1f}ms  "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms  max {latencies[-1] * 1000:.1f}ms")
+    print(f"cache {cache.hits} hits  {cache.misses} misses")
+
+
+def scanViewport(trips, trajectories, minLon, minLat, maxLon, maxLat, epoch):
+    """
+    Linear scan answering TrainIndex.viewport: the position of every trajectory at epoch
+    """
+    found = []
+    for trip, trajectory in zip(trips, trajectories):
+        if len(trajectory) < 2 or not trajectory['t'][0] <= epoch <= trajectory['t'][-1]:
+            continue
+        lat = np.interp(epoch, trajectory['t'], trajectory['lat'])
+        lon = np.interp(epoch, trajectory['t'], trajectory['lon'])
+        if minLat <= lat <= maxLat and minLon <= lon <= maxLon:
+            found.append(trip[0][5])
+    return found
+
+
+def benchIndex(epoch, queries=1000):
+    """
+    Compares the viewport and nearest queries of the train index with a linear scan of the
+    trajectories of the hour following epoch, on random viewports of about 20 km
+    :param epoch: start of the hour
+    :param queries: number of queries
+    """
+    epoch, queries = int(epoch), int(queries)
+    G = osm.loadGraph()
+    trips = storage.getBackend().activeTrips(epoch, epoch + 3600)
+    trajectories = osm.retrieveTrajectories(trips, G)
+    start = time.perf_counter()
+    index = trainindex.TrainIndex(trips, trajectories)
+    print(f"{len(index)} trains indexed in {time.perf_counter() - start:.2f}s")
+    if not len(index):
+        return
+
+    minLon, minLat, maxLon, maxLat = index.bounds
+    viewports = []
+    for _ in range(queries):
+        lon, lat = random.uniform(minLon, maxLon), random.uniform(minLat, maxLat)
+        viewports.append((lon - 0.15, lat - 0.1, lon + 0.15, lat + 0.1, random.uniform(epoch, epoch + 3600)))
+
+    start = time.perf_counter()
+    expected = [scanViewport(trips, trajectories, *viewport) for viewport in viewports]
+    scanTime = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [index.viewport(*viewport)[0] for viewport in viewports]
+    indexTime = time.perf_counter() - start
+    start = time.perf_counter()
+    for lon0, lat0, lon1, lat1, at in viewports:
+        index.nearest((lat0 + lat1) / 2, (lon0 + lon1) / 2, at)
+    nearestTime = time.perf_counter() - start
+
+    mismatches = sum(set(a) != set(b.tolist()) for a, b in zip(expected, found))
+    for label, elapsed in (("scan", scanTime), ("viewport", indexTime), ("nearest", nearestTime)):
+        print(f"{label.ljust(10)} {elapsed / queries * 1000:.3f} ms/query")
+    print(f"{mismatches} viewports answered differently by the scan and the index")
+
+
+BENCHMARKS = {
+    "ingest": benchIngest,
+    "decode": benchDecode,
+    "backends": benchBackends,
+    "routing": benchRouting,
+    "service": benchService,
+    "index": benchIndex,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("usage: python benchmark.py [%s] [arguments]" % "|".join(BENCHMARKS))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
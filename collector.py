@@ -0,0 +1,275 @@
+import asyncio
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import psycopg2
+
+import db
+import delaystats
+
+"""
+Long-running collector of live GTFS-RT feeds. Each endpoint is polled on an interval with
+conditional requests (ETag / If-Modified-Since), and polled again later with an exponential
+backoff when it fails. Feeds are decoded in a process pool, off the event loop, and a single
+writer task streams the decoded trips into the incremental bulk ingestion of db.py.
+The latency of the fetch, decode and write stages is printed for every poll, and kept for the
+last LATENCY_HISTORY polls.
+
+ArchiveServer serves the archived files of data/ as a live endpoint, one file after the other,
+to try the collector locally.
+Usage:
+    python collector.py poll <url> [<url> ...]
+    python collector.py serve [port]
+    python collector.py demo [polls]
+"""
+
+POLL_INTERVAL = 30
+MAX_BACKOFF = 600
+TIMEOUT = 20
+# Polls whose latencies are kept for the summary of demo
+LATENCY_HISTORY = 1000
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        self.etag = None
+        self.lastModified = None
+        self.digest = None
+        self.failures = 0
+
+
+def fetchFeed(endpoint):
+    """
+    Downloads a feed with a conditional request
+    :return: the content of the feed, or None when it did not change since the last poll
+    """
+    headers = {}
+    if endpoint.etag:
+        headers['If-None-Match'] = endpoint.etag
+    if endpoint.lastModified:
+        headers['If-Modified-Since'] = endpoint.lastModified
+    try:
+        with urlopen(Request(endpoint.url, headers=headers), timeout=TIMEOUT) as response:
+            data = response.read()
+            endpoint.etag = response.headers.get('ETag')
+            endpoint.lastModified = response.headers.get('Last-Modified')
+    except HTTPError as error:
+        if error.code == 304:
+            return None
+        raise
+    # Some servers answer every request in full: skip the content that was already ingested
+    digest = hashlib.sha256(data).hexdigest()
+    if digest == endpoint.digest:
+        return None
+    endpoint.digest = digest
+    return data
+
+
+class Collector:
+    def __init__(self, urls, interval=POLL_INTERVAL, workers=2):
+        """
+        :param urls: GTFS-RT endpoints to poll
+        :param interval: seconds between two polls of an endpoint
+        :param workers: number of decoding processes
+        """
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.interval = interval
+        self.workers = workers
+        self.latencies = deque(maxlen=LATENCY_HISTORY)
+
+    async def run(self, polls=None):
+        """
+        Polls every endpoint until cancelled, or polls times each
+        """
+        self.queue = asyncio.Queue(maxsize=16)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.conn = self.cur = None
+        self.connect()
+        writer = asyncio.create_task(self.writeLoop())
+        try:
+            await asyncio.gather(*(self.pollLoop(endpoint, polls) for endpoint in self.endpoints))
+            await self.queue.join()
+        finally:
+            writer.cancel()
+            self.executor.shutdown()
+            self.disconnect()
+
+    async def pollLoop(self, endpoint, polls):
+        loop = asyncio.get_running_loop()
+        count = 0
+        while polls is None or count < polls:
+            count += 1
+            record = {"url": endpoint.url, "start": time.time()}
+            start = time.perf_counter()
+            try:
+                data = await asyncio.to_thread(fetchFeed, endpoint)
+                record["fetch"] = time.perf_counter() - start
+                if data is not None:
+                    start = time.perf_counter()
+                    trips = await loop.run_in_executor(self.executor, db.decodeGtfsPayload, data)
+                    record["decode"] = time.perf_counter() - start
+                    await self.queue.put((record, trips))
+                else:
+                    record["status"] = "not modified"
+                    self.report(record)
+                endpoint.failures = 0
+                delay = self.interval
+            except Exception as error:
+                endpoint.failures += 1
+                record["status"] = "error: %s" % error
+                self.report(record)
+                delay = min(self.interval * 2 ** endpoint.failures, MAX_BACKOFF)
+                delay *= random.uniform(0.8, 1.2)
+            if polls is None or count < polls:
+                await asyncio.sleep(delay)
+
+    async def writeLoop(self):
+        while True:
+            record, trips = await self.queue.get()
+            start = time.perf_counter()
+            try:
+                record["rows"] = await asyncio.to_thread(self.write, trips)
+                record["status"] = "ok"
+            except Exception as error:
+                record["status"] = "write error: %s" % error
+                try:
+                    await asyncio.to_thread(self.recover, error)
+                except Exception as recoveryError:
+                    record["status"] += ", reconnection failed: %s" % recoveryError
+            finally:
+                record["write"] = time.perf_counter() - start
+                self.report(record)
+                self.queue.task_done()
+
+    def connect(self):
+        conn, cur = db.connectToDB()
+        try:
+            db.prepareIncremental(cur)
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        self.conn, self.cur = conn, cur
+
+    def disconnect(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.conn = self.cur = None
+
+    def recover(self, error):
+        """
+        Rolls back a failed write, or opens a new connection when the previous one was lost.
+        A failed reconnection is tried again after the next failed write.
+        """
+        if self.conn is not None and not self.conn.closed \
+                and not isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            try:
+                self.conn.rollback()
+                return
+            except psycopg2.Error:
+                pass
+        self.disconnect()
+        self.connect()
+
+    def write(self, trips):
+        if self.conn is None:
+            raise psycopg2.InterfaceError("no connection to the database")
+        tripIds, written, stale = db.upsertTrips(self.cur, trips)
+        delaystats.refreshDelayStats(self.cur, tripIds, stale)
+        self.conn.commit()
+        return written
+
+    def report(self, record):
+        self.latencies.append(record)
+        stages = "  ".join(f"{stage} {record[stage] * 1000:.0f}ms"
+                           for stage in ("fetch", "decode", "write") if stage in record)
+        rows = f"  {record['rows']} rows" if "rows" in record else ""
+        print(f"{record['url']}: {record.get('status', '')}  {stages}{rows}")
+
+
+class ArchiveServer(ThreadingHTTPServer):
+    """
+    Local stand-in of a GTFS-RT endpoint: serves the archived gtfsrt files of the data folder,
+    moving to the next file every period seconds, and answers 304 to conditional requests when
+    the file did not change
+    """
+
+    def __init__(self, port=8080, dataPath="data/", period=5):
+        self.dataPath = dataPath
+        self.files = db.listGtfsFiles(dataPath)
+        self.period = period
+        self.started = time.time()
+        super().__init__(("127.0.0.1", port), ArchiveHandler)
+
+    def currentFile(self):
+        index = int((time.time() - self.started) // self.period) % len(self.files)
+        return index, self.files[index]
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        index, file = self.server.currentFile()
+        etag = '"%s"' % file
+        lastModified = formatdate(self.server.started + index * self.server.period, usegmt=True)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        with open(os.path.join(self.server.dataPath, file), 'rb') as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', lastModified)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def demo(polls=10):
+    """
+    Polls a local ArchiveServer and prints the latency of each stage
+    """
+    server = ArchiveServer(port=0, period=2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/feed" % server.server_address[1]
+    collector = Collector([url], interval=1)
+    try:
+        asyncio.run(collector.run(polls=int(polls)))
+    finally:
+        server.shutdown()
+    done = [record for record in collector.latencies if "write" in record]
+    for stage in ("fetch", "decode", "write"):
+        values = [record[stage] for record in done]
+        if values:
+            print(f"{stage.ljust(7)} mean {sum(values) / len(values) * 1000:.0f}ms  max {max(values) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "poll" and len(sys.argv) > 2:
+        asyncio.run(Collector(sys.argv[2:]).run())
+    elif command == "serve":
+        ArchiveServer(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8080).serve_forever()
+    elif command == "demo":
+        demo(*sys.argv[2:])
+    else:
+        print("usage: python collector.py poll <url> [<url> ...] | serve [port] | demo [polls]")
+        sys.exit(1)
@@ -1,31 +1,38 @@
+from datetime import datetime, timezone
 from urllib.request import urlopen
 
 from google.protobuf.json_format import MessageToDict
 from google.transit import gtfs_realtime_pb2
 
+import stations
+
 
 def findStationPositions():
     """
-    Opens the gtfs/stops.txt and retrieves each line. In each line, we retrieve the information of
-    the station, based on the stopID.
-    IMPORTANT: please change the path to the location of your gtfs/stops.txt file
-    :return: the dictionary containing the stopID as the key and the rest of infos as values.
+    Retrieves the information of each station of gtfs/stops.txt, based on the stopID. The file is
+    parsed once per process by the stations module.
+    :return: the dictionary containing the stopID as the key and [name, latitude, longitude] as values.
     """
-    # path = "C:/Users/maeva/Desktop/geo/gtfs/stops.txt"
-    path = "data/gtfs/stops.txt"
+    return stations.loadStationIndex().positionsDict()
+
 
-    valuesSeen = set()
-    positionsDict = {}
-    with open(path, 'r') as f:
-        for line in f:
-            stopId = line.split(',')[0]
+def parseFeed(data):
+    """
+    :param data: content of a gtfsrt file
+    :return: the FeedMessage object
+    """
+    gtfs_realtime = gtfs_realtime_pb2.FeedMessage()
+    gtfs_realtime.ParseFromString(data)
+    return gtfs_realtime
 
-            if '_' in stopId:
-                stopId = stopId.split('_')[0]
-            if stopId not in valuesSeen and stopId.isdigit():
-                valuesSeen.add(stopId)
-                addLocations(stopId, line, positionsDict)
-    return positionsDict
+
+def readFeed(url):
+    """
+    Allows to retrieve the gtfsrt file content as a protobuf FeedMessage
+    :param url: path of the file under the url format
+    :return: the FeedMessage object
+    """
+    return parseFeed(urlopen(url).read())
 
 
 def preprocessing(url):
@@ -34,24 +41,55 @@ def preprocessing(url):
     :param url: path of the file under the url format
     :return: the dictionary object
     """
-    gtfs_realtime = gtfs_realtime_pb2.FeedMessage()
-    gtfs_realtime.ParseFromString(urlopen(url).read())
-    dict_obj = MessageToDict(gtfs_realtime)
+    dict_obj = MessageToDict(readFeed(url))
     return dict_obj
 
 
-def addLocations(stopId, line, positionsDict):
+def extractStopTimes(url):
     """
-    Function that allows retrieving the name, longitude and latitude of a station based on its ID
-    :param stopId: ID of the station
-    :param line: line of the file "stops.txt", where all the information about stations are written
-    :param positionsDict: dictionary to which is appended the new location, longitude and latitude
-    as values, and the stopID as key
-    :return: dictionary mentioned earlier
+    Walks the trip updates of a gtfsrt file directly on the protobuf objects, without building
+    the dictionary of preprocessing. A stop without departure reuses the departure of the
+    previous stop, and the last stop of a trip uses its arrival time and delay.
+    :param url: path of the file under the url format
+    :return: generator yielding, for each trip update, a list of (stopId, time, delay, tripKey)
+    tuples, where tripKey is the (trip_id, start_date) pair of the trip, see serviceDate
     """
+    return feedStopTimes(readFeed(url))
+
 
-    location = line.split(',')[2]
-    longitude = line.split(',')[4]
-    lattitude = line.split(',')[5]
+def feedStopTimes(feed):
+    """
+    Same as extractStopTimes, for a FeedMessage that is already decoded
+    """
+    for entity in feed.entity:
+        if not entity.HasField('trip_update'):
+            continue
+        tripUpdate = entity.trip_update
+        tripKey = (tripUpdate.trip.trip_id, tripUpdate.trip.start_date)
+        stops = tripUpdate.stop_time_update
+        last = len(stops) - 1
+        stopTimes = []
+        departure = None
+        for i, stop in enumerate(stops):
+            if i == last:
+                stopTimes.append((stop.stop_id, stop.arrival.time, stop.arrival.delay, tripKey))
+            else:
+                if stop.HasField('departure'):
+                    departure = (stop.departure.time, stop.departure.delay)
+                if departure is not None:
+                    stopTimes.append((stop.stop_id, departure[0], departure[1], tripKey))
+        if stopTimes and not tripKey[1]:
+            tripKey = (tripKey[0], serviceDate(stopTimes[0][1]))
+            stopTimes = [(stopId, epoch, delay, tripKey) for stopId, epoch, delay, _ in stopTimes]
+        yield stopTimes
+
+
+def serviceDate(epoch):
+    """
+    Stands for the start_date of a trip when the feed leaves it out, so that the runs of a
+    trip_id on different days keep different keys
+    :param epoch: time of the first stop of the trip
+    :return: the UTC date of the time, in the YYYYMMDD format of start_date
+    """
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).strftime("%Y%m%d")
 
-    positionsDict[stopId] = [location, longitude, lattitude]
@@ -1,31 +1,80 @@
-import os
-import webbrowser
-
 from PyQt5 import QtWebEngineWidgets
-from PyQt5.QtWebEngineWidgets import QWebEngineView
+from PyQt5.QtWebEngineWidgets import QWebEngineView, QWebEngineSettings
 from dateutil.parser import parse
 from PyQt5.QtWidgets import QComboBox, QDateEdit, QApplication, QWidget, QPushButton, \
     QVBoxLayout, QLabel, QLineEdit, QTabWidget, QHBoxLayout, QGridLayout, QSpacerItem, QSizePolicy, \
     QMessageBox, QMainWindow, QTextBrowser, QPlainTextEdit
 from PyQt5.QtGui import QPalette, QColor
-from PyQt5.QtCore import QDate, Qt, QUrl
+from PyQt5.QtCore import QDate, Qt, QUrl, QObject, QRunnable, QThreadPool, pyqtSignal
 from datetime import datetime
-import osmnx as ox
+import analytics
+import osm
 import visualization
-from db import retrieveStations
+from stations import loadStationIndex
+
+
+class Cancelled(Exception):
+    pass
+
+
+class TaskSignals(QObject):
+    """
+    Signals of a Task, emitted from the worker thread and delivered to the UI thread.
+    Each carries the generation of the task, so that the window can drop stale results.
+    """
+    progress = pyqtSignal(int, str)
+    result = pyqtSignal(int, object)
+    error = pyqtSignal(int, str)
+    finished = pyqtSignal(int)
+
+
+class Task(QRunnable):
+    """
+    Runs job(task) on a thread pool. The job calls task.step between its stages: it reports
+    the progress, and stops the job with Cancelled once the task was cancelled.
+    """
+
+    def __init__(self, generation, job):
+        QRunnable.__init__(self)
+        self.setAutoDelete(False)
+        self.generation = generation
+        self.job = job
+        self.cancelled = False
+        self.signals = TaskSignals()
+
+    def step(self, message):
+        if self.cancelled:
+            raise Cancelled()
+        self.signals.progress.emit(self.generation, message)
+
+    def run(self):
+        try:
+            result = self.job(self)
+            if not self.cancelled:
+                self.signals.result.emit(self.generation, result)
+        except Cancelled:
+            pass
+        except Exception as error:
+            self.signals.error.emit(self.generation, str(error))
+        finally:
+            self.signals.finished.emit(self.generation)
 
 
 class Fenetre(QWidget):
     def __init__(self):
         QWidget.__init__(self)
-        graphPath = 'railwayGraph.graphml'
-        if os.path.exists(graphPath):
-            G = ox.load_graphml(graphPath)
-        else:
-            place_name = "Belgium"
-            G = ox.graph_from_place(place_name, custom_filter='["railway"]')
-            ox.save_graphml(G, graphPath)
-        self.osmdata = G
+        # Searches run one at a time off the UI thread, a new one supersedes the previous one
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.task = None
+        self.generation = 0
+        # Started tasks, kept alive until their worker returns
+        self.running = {}
+
+        self.osmdata = None
+        # Script waiting for the embedded map to be loaded
+        self.mapReady = False
+        self.pendingScript = None
 
         self.initWindow()
 
@@ -33,17 +82,51 @@ class Fenetre(QWidget):
 
         self.setpage(self.page2)
 
+        self.page3 = self.createStatisticsPage()
+
         # Add tabs to main window
         self.setTabs(self.page2)
 
+        self.loadGraph()
+
+    def loadGraph(self):
+        """
+        Load the railway graph and its snapping table in the background,
+        the search is enabled once they are ready
+        """
+        def job(task):
+            G = osm.loadGraph()
+            osm.loadSnapTable(G)
+            return G
+
+        self.page2.search.setEnabled(False)
+        self.page2.live.setEnabled(False)
+        self.page2.status.setText(self.idleStatus())
+        self.loader = Task(0, job)
+        self.loader.signals.result.connect(lambda generation, G: self.graphLoaded(G))
+        self.loader.signals.error.connect(lambda generation, message: self.page2.status.setText(
+            "Could not load the railway graph: " + message))
+        QThreadPool.globalInstance().start(self.loader)
+
+    def graphLoaded(self, G):
+        self.osmdata = G
+        self.page2.search.setEnabled(True)
+        self.page2.live.setEnabled(True)
+        if self.task is None:
+            self.page2.status.setText(self.idleStatus())
+
+    def idleStatus(self):
+        return "Loading the railway graph..." if self.osmdata is None else ""
+
     def setTabs(self, page2):
         self.qtw = QTabWidget(self)
         self.qtw.addTab(page2, "Trip details")
+        self.qtw.addTab(self.page3, "Statistics")
         # Stylize the main window
-        self.setMinimumWidth(1000)
+        self.setMinimumWidth(1500)
         self.setMinimumHeight(800)
         # Stylize the sub-pages
-        self.qtw.setMinimumWidth(1000)
+        self.qtw.setMinimumWidth(1400)
         self.qtw.setMinimumHeight(750)
         self.qtw.move(60, 60)
         self.setWindowTitle("Dashboard")
@@ -58,8 +141,15 @@ class Fenetre(QWidget):
         self.setTime(page2)
         # Add list of stationstationList
         self.setStationsList(page2)
+        self.setMapView(page2)
         # Sub-layouts
         self.setLayouts(self.departure, self.destination, page2)
+        # A search running for other inputs is stale
+        self.departure.currentIndexChanged.connect(self.cancelTask)
+        self.destination.currentIndexChanged.connect(self.cancelTask)
+        page2.date.dateChanged.connect(self.cancelTask)
+        page2.hours.textEdited.connect(self.cancelTask)
+        page2.minutes.textEdited.connect(self.cancelTask)
 
     def setLayouts(self, departure, destination, page2):
         """
@@ -86,6 +176,8 @@ class Fenetre(QWidget):
         # Layout page 2
         layout2 = QGridLayout()
         layout2.addWidget(page2.lab0, 0, 0)
+        layout2.addWidget(page2.map, 0, 1, 12, 1)
+        layout2.setColumnStretch(1, 1)
         layout2.addLayout(slayout2, 1, 0)
         layout2.addLayout(slayout1, 2, 0)
         layout2.addWidget(page2.lab3, 3, 0)
@@ -94,7 +186,9 @@ class Fenetre(QWidget):
         layout2.addWidget(destination, 6, 0)
         layout2.addWidget(page2.search, 7, 0)
         layout2.addWidget(page2.mean, 8, 0)
-        layout2.addWidget(page2.stationList, 9, 0)
+        layout2.addWidget(page2.live, 9, 0)
+        layout2.addWidget(page2.stationList, 10, 0)
+        layout2.addWidget(page2.status, 11, 0)
         verticalSpacer = QSpacerItem(40, 30, QSizePolicy.Minimum, QSizePolicy.Expanding)
         layout2.addItem(verticalSpacer, 7, 0, Qt.AlignTop)
         page2.setLayout(layout2)
@@ -113,27 +207,16 @@ class Fenetre(QWidget):
     
 
     def setScrollBox(self, page2, station_names):
-        with open('data/gtfs/stops.txt', 'r') as file:
-            trips = file.readlines()[1:]
         # Ajout de la sélection du départ et destination
         departure = QComboBox(page2)
         destination = QComboBox(page2)
-        
-        # Retrieving all stops in the file
-        sortedList = []
-        for line in trips:
-            trip_list = line.split(',')
-            trip = trip_list[2].split(' ')[0]
+
+        # Retrieving all stops from the shared station index
+        for trip in loadStationIndex().displayNames():
             if trip not in station_names:
-                sortedList.append(trip)
-        
-        # Remove redondancy and sort station's list
-        sortedList = sorted(list(set(sortedList)))
-        
-        for trip in sortedList:
-            station_names.add(trip)
-            destination.addItem(trip)
-            departure.addItem(trip)
+                station_names.add(trip)
+                destination.addItem(trip)
+                departure.addItem(trip)
         return departure, destination
 
     def setLabels(self, page2):
@@ -158,6 +241,10 @@ class Fenetre(QWidget):
         page2.mean.clicked.connect(self.showMeanDelay)
         page2.mean.setStyleSheet("QPushButton {margin-bottom:25px;padding:5px;}")
         page2.mean.setFixedWidth(300)
+        page2.live = QPushButton("All trains in the next hour")
+        page2.live.clicked.connect(self.showLiveMap)
+        page2.live.setStyleSheet("QPushButton {margin-bottom:25px;padding:5px;}")
+        page2.live.setFixedWidth(300)
         page2.search.setFixedWidth(300)
         return page2
 
@@ -169,6 +256,56 @@ class Fenetre(QWidget):
         self.setPalette(palette)
     
     
+    def startTask(self, job, onResult, onError=None):
+        """
+        Runs job(task) off the UI thread, after cancelling the running task.
+        onResult is called in the UI thread with the result of the job, unless a newer task was started.
+        onError is called the same way with the message of a failed job, which is shown in the
+        status bar of the search page when it is not given.
+        """
+        self.cancelTask()
+        self.generation += 1
+        task = Task(self.generation, job)
+        task.signals.progress.connect(self.showProgress)
+        task.signals.error.connect(lambda generation, message: self.showTaskError(generation, message, onError))
+        task.signals.result.connect(lambda generation, result: self.finishTask(generation, result, onResult))
+        task.signals.finished.connect(lambda generation: self.running.pop(generation, None))
+        self.task = task
+        self.running[task.generation] = task
+        self.pool.start(task)
+
+    def cancelTask(self):
+        if self.task is not None:
+            self.task.cancelled = True
+            self.task = None
+            self.page2.status.setText(self.idleStatus())
+
+    def isCurrent(self, generation):
+        return self.task is not None and generation == self.task.generation
+
+    def showProgress(self, generation, message):
+        if self.isCurrent(generation):
+            self.page2.status.setText(message + "...")
+
+    def showTaskError(self, generation, message, onError=None):
+        if self.isCurrent(generation):
+            self.task = None
+            if onError is None:
+                self.page2.status.setText("Search failed: " + message)
+            else:
+                self.page2.status.setText(self.idleStatus())
+                onError(message)
+
+    def finishTask(self, generation, result, onResult):
+        if self.isCurrent(generation):
+            self.task = None
+            self.page2.status.setText(self.idleStatus())
+            onResult(result)
+
+    def closeEvent(self, event):
+        self.cancelTask()
+        QWidget.closeEvent(self, event)
+
     def showMeanDelay(self):
         """
         Display on the interface the average delay for each station
@@ -187,18 +324,119 @@ class Fenetre(QWidget):
         if departureStation == arrivalStation:
             self.showInvalidTrip()
             return
-        
-        means = visualization.meanDelays(departureStation, arrivalStation, self.retrieveTime(), epochMorning, epochEvening)
-        
-        #print("------ Mean Delay -------")
-        #print(means)
-        
+
+        epoch = self.retrieveTime()
+
+        def job(task):
+            task.step("Reading the delay statistics")
+            return visualization.meanDelays(departureStation, arrivalStation, epoch, epochMorning, epochEvening)
+
+        self.startTask(job, self.showMeans)
+
+    def showLiveMap(self):
+        """
+        Display every train running during the hour following the selected time
+        """
+        epoch = self.retrieveTime()
+        osmdata = self.osmdata
+
+        def job(task):
+            task.step("Building the trajectories of all trains")
+            features = visualization.liveFeatures(osmdata, epoch, epoch + 3600)
+            task.step("Preparing the map")
+            return len(features), visualization.featureCollection(features)
+
+        def show(result):
+            trains, data = result
+            self.page2.status.setText(str(trains) + " trains running")
+            self.showOnMap(data)
+
+        self.startTask(job, show)
+
+    def createStatisticsPage(self):
+        """
+        Create the page showing the delay analytics of the selected day
+        """
+        page3 = QWidget()
+        page3.compute = QPushButton("Delay statistics of this day")
+        page3.compute.clicked.connect(self.showStatistics)
+        page3.compute.setFixedWidth(300)
+        page3.export = QPushButton("Export")
+        page3.export.clicked.connect(self.exportStatistics)
+        page3.export.setFixedWidth(300)
+        page3.export.setEnabled(False)
+        page3.text = QPlainTextEdit()
+        page3.text.setReadOnly(True)
+        page3.text.setStyleSheet("QPlainTextEdit {color:#4400AA;font-family:monospace;}")
+        page3.results = None
+        layout = QGridLayout()
+        layout.addWidget(page3.compute, 0, 0)
+        layout.addWidget(page3.export, 0, 1)
+        layout.addWidget(page3.text, 1, 0, 1, 2)
+        page3.setLayout(layout)
+        return page3
+
+    def showStatistics(self):
+        """
+        Compute the delay analytics of the selected day off the UI thread
+        """
+        today = parse(self.page2.date.date().toString())
+        epochMorning = int(datetime(today.year, today.month, today.day, 0, 0).timestamp())
+        epochEvening = epochMorning + 86400
+
+        def job(task):
+            task.step("Loading the stops of the day")
+            frame = analytics.loadHistory(epochMorning, epochEvening)
+            task.step("Computing the statistics")
+            return len(frame), analytics.summary(frame)
+
+        self.page3.text.setPlainText("Computing...")
+        self.startTask(job, self.showResults,
+                       lambda message: self.page3.text.setPlainText("Statistics failed: " + message))
+
+    def showResults(self, result):
+        stops, results = result
+        self.page3.results = results
+        self.page3.export.setEnabled(stops > 0)
+        text = self.page3.text
+        text.clear()
+        text.appendPlainText(str(stops) + " stops")
+        text.appendPlainText("")
+        text.appendPlainText("[WORST STATION]".ljust(24) + "[STOPS]   [MEAN]     [MAX]")
+        for row in results["worstStations"].itertuples():
+            text.appendPlainText(row.nameStation.ljust(24) + str(row.stops).ljust(10)
+                                 + ("%.1f min" % (row.mean / 60)).ljust(11) + "%d min" % (row.max / 60))
+        text.appendPlainText("")
+        text.appendPlainText("[HOUR]   [STOPS]   [MEAN]     [P90]")
+        for row in results["hourProfile"].itertuples():
+            text.appendPlainText(("%02dh" % row.hour).ljust(9) + str(row.stops).ljust(10)
+                                 + ("%.1f min" % (row.mean / 60)).ljust(11) + "%.1f min" % (row.p90 / 60))
+        text.appendPlainText("")
+        text.appendPlainText("[SECTION]".ljust(44) + "[RUNS]   [DELAY GAINED]")
+        for row in results["propagation"].head(15).itertuples():
+            text.appendPlainText((row.fromStation + " > " + row.toStation).ljust(44) + str(row.runs).ljust(9)
+                                 + "%+.1f min" % (row.meanGained / 60))
+
+    def exportStatistics(self):
+        results = self.page3.results
+        if results is None:
+            return
+
+        def job(task):
+            task.step("Exporting the statistics")
+            return analytics.exportResults(results)
+
+        self.startTask(job, lambda files: self.page3.text.appendPlainText("\nExported to " + ", ".join(files)),
+                       lambda message: self.page3.text.appendPlainText("\nExport failed: " + message))
+
+    def showMeans(self, means):
         # Clear list before printing new one
         self.page2.stationList.clear()
-        self.page2.stationList.appendPlainText("[STATION]".ljust(20) + "   " + "[MEAN DELAY]")
+        self.page2.stationList.appendPlainText("[STATION]".ljust(20) + "   " + "[MEAN DELAY]" + "   " + "[P90]" + "     " + "[MAX]")
         
         for row in means:
-            self.page2.stationList.appendPlainText(row[0].ljust(20) + "       " + str(row[1]) + " min")
+            self.page2.stationList.appendPlainText(row[0].ljust(20) + "       " + (str(row[1]) + " min").ljust(11)
+                                                   + "   " + (str(row[3]) + " min").ljust(7) + "   " + str(row[4]) + " min")
         
         
         
@@ -213,26 +451,22 @@ class Fenetre(QWidget):
         return int(epochTime)
         
         
-    def showStationsList(self, departureStation, arrivalStation):
+    def showStationsList(self, stationList, departureStation, arrivalStation, epoch):
         """
         Show a list of all stations between arrival and departure,
         alongside with their arrival time and time delay
+        :param stationList: the stops of the trip found by the search
         """
-        stationList = visualization.retrieveInDb(departureStation, arrivalStation, self.retrieveTime())
-        
-        #print("------ Station List -------")
-        #print(stationList)
-       
         # We don't need stations out of selected inputs
         relevantStations = []
         relevant = False
         for station in stationList:
             if station[1] == arrivalStation or station[1] == departureStation:
-                if self.retrieveTime() < int(station[4]):
+                if epoch < int(station[4]):
                     relevantStations.append(station)
                 relevant = not relevant
             elif relevant:
-                if self.retrieveTime() < int(station[4]):
+                if epoch < int(station[4]):
                     relevantStations.append(station)
         
         
@@ -261,19 +495,58 @@ class Fenetre(QWidget):
         if departureStation == arrivalStation:
             self.showInvalidTrip()
             return
-        else:
-            data = visualization.gtfsData(self.osmdata, [departureStation, arrivalStation, time])
+
+        # The search, the trajectory and the map are computed off the UI thread
+        osmdata = self.osmdata
+
+        def job(task):
+            data = visualization.gtfsData(osmdata, [departureStation, arrivalStation, time], task.step, render=False)
+            if data.found:
+                task.step("Preparing the map")
+                data.features = visualization.featureCollection(visualization.tripFeatures(data.trajectory, time))
+            return data
+
+        def show(data):
             if data.found:
-                file_ = data.file
-                webbrowser.open(data.file)
+                self.showOnMap(data.features)
             else:
                 self.showNoTripFound()
-    
-        self.showStationsList(departureStation, arrivalStation)
+            self.showStationsList(data.trip, departureStation, arrivalStation, time)
+
+        self.startTask(job, show)
         
         
     
     
+    def setMapView(self, page2):
+        """
+        Create the embedded map, loaded once: the trajectories are then
+        pushed to the loaded page, see showOnMap
+        """
+        page2.map = QWebEngineView()
+        page2.map.setMinimumWidth(700)
+        # The base page is a local file using the map assets and tiles of the web
+        page2.map.settings().setAttribute(QWebEngineSettings.LocalContentCanAccessRemoteUrls, True)
+        page2.map.loadFinished.connect(self.mapLoaded)
+        page2.map.load(QUrl.fromLocalFile(visualization.basePage()))
+
+    def mapLoaded(self, ok):
+        self.mapReady = ok
+        if ok and self.pendingScript is not None:
+            self.page2.map.page().runJavaScript(self.pendingScript)
+            self.pendingScript = None
+
+    def showOnMap(self, featureCollection):
+        """
+        Replace the trains shown on the embedded map
+        :param featureCollection: JSON text of the features, see visualization.featureCollection
+        """
+        script = "loadTrains(%s);" % featureCollection
+        if self.mapReady:
+            self.page2.map.page().runJavaScript(script)
+        else:
+            self.pendingScript = script
+
     def setStationsList(self, page2):
         """
         Create and display a list of stations
@@ -284,6 +557,8 @@ class Fenetre(QWidget):
         #page2.stationList.setEnabled(False)
         page2.stationList.setFixedHeight(200)
         page2.stationList.setStyleSheet("QPlainTextEdit {color:#4400AA;font-family:monospace;}")
+        # Progress of the running search
+        page2.status = QLabel("")
         
         
     def showNoTripFound(self):
@@ -1,6 +1,17 @@
+import csv
+import io
+import itertools
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import psycopg2
+from psycopg2.extras import execute_values
 import os
 import common
+import dbsession
+import delaystats
+import schema
 
 """
 sudo -u postgres psql
@@ -11,37 +22,110 @@ CREATE DATABASE traindb;
 GRANT ALL PRIVILEGES ON DATABASE traindb TO geoProject;
 """
 
-def main():
+# Number of rows buffered before they are sent to the database in bulk mode
+BATCH_SIZE = 5000
+STATION_COLUMNS = ("nameStation", "latStation", "longStation", "arrivalTime", "trip", "delay", "stopId")
+INSERT_STATION = "INSERT INTO station (nameStation, latStation, longStation, arrivalTime, trip, delay, stopId) " \
+                 "VALUES (%s, %s, %s, %s, %s, %s, %s)"
+STAGING_COLUMNS = ("nameStation", "latStation", "longStation", "arrivalTime", "delay", "stopId", "tripId", "serviceDate")
+
+
+def main(bulk=True, workers=os.cpu_count(), partitioned=False, incremental=True):
+    """
+    :param incremental: only load the files missing from the ledger of ingested files. Otherwise
+    the station table is rebuilt from scratch.
+    :param partitioned: partition the rebuilt table by service day, only when not incremental
+    """
     con, cur = connectToDB()
-    createTable(cur)
-    importGtfsData(cur)
+    if incremental:
+        prepareIncremental(cur)
+    else:
+        createTable(cur, partitioned)
+    con.commit()
+    importGtfsData(con, cur, bulk=bulk, workers=workers, incremental=incremental)
     printTable(con, cur)
     cur.close()
     con.close()
 
 
+def prepareIncremental(cur):
+    """
+    Creates the tables of the incremental ingestion when they are missing
+    """
+    if not schema.ingestionReady(cur):
+        # First incremental run: the trips of a full rebuild are not identified by their GTFS trip_id
+        createTable(cur)
+        schema.createIngestionTables(cur)
+    schema.createStagingTable(cur)
+
+
 def connectToDB():
-    conn = psycopg2.connect(database="traindb", user="postgres", password="password", host="localhost", port="5432")
+    conn = psycopg2.connect(**dbsession.connectionParameters())
     cur = conn.cursor()
     return conn, cur
 
 
-def createTable(cur):
+def createTable(cur, partitioned=False):
+    """
+    Creates the station table and its indexes
+    :param partitioned: partition the table by service day, the daily partitions being created
+    during the import
+    """
     cur.execute("DROP TABLE IF EXISTS station;")
-    cur.execute('''CREATE TABLE station
-               (id SERIAL PRIMARY KEY,
-                nameStation TEXT,
-                latStation FLOAT,
-                longStation FLOAT,
-                arrivalTime INT,
-                trip INT,
-                delay INT);''')
+    schema.dropIngestionTables(cur)
+    if partitioned:
+        cur.execute('''CREATE TABLE station
+                   (id SERIAL,
+                    nameStation TEXT,
+                    latStation FLOAT,
+                    longStation FLOAT,
+                    arrivalTime INT,
+                    trip INT,
+                    delay INT,
+                    stopId INT,
+                    PRIMARY KEY (id, arrivalTime)) PARTITION BY RANGE (arrivalTime);''')
+        cur.execute("CREATE TABLE station_default PARTITION OF station DEFAULT")
+    else:
+        cur.execute('''CREATE TABLE station
+                   (id SERIAL PRIMARY KEY,
+                    nameStation TEXT,
+                    latStation FLOAT,
+                    longStation FLOAT,
+                    arrivalTime INT,
+                    trip INT,
+                    delay INT,
+                    stopId INT);''')
+    schema.createIndexes(cur)
+    delaystats.createStatsTables(cur)
+
+
+def toRow(data):
+    """
+    Converts a station returned by findStations into a tuple following STATION_COLUMNS
+    :param data: [[name, latitude, longitude], time, trip, delay, stopId]
+    :return: the typed tuple
+    """
+    return data[0][0], float(data[0][1]), float(data[0][2]), int(data[1]), data[2], int(data[3]), int(data[4])
 
 
-def insertInTable(cur, data):
-    cur.execute("INSERT INTO station (nameStation, latStation, longStation, arrivalTime, trip, delay) VALUES (%s, %s, %s, "
-                "%s, %s, %s)",
-                (data[0][0], float(data[0][1]), float(data[0][2]), int(data[1]), data[2], int(data[3])))
+def copyRows(cur, rows, method="copy", table="station", columns=STATION_COLUMNS):
+    """
+    Writes a batch of rows into the station table with a single statement
+    :param rows: list of tuples following STATION_COLUMNS, as returned by toRow
+    :param method: "copy" streams the batch with COPY FROM STDIN, "values" falls back to a
+    multi-row INSERT built by execute_values
+    :param table: table to write into, with the names of the columns of the tuples
+    """
+    columns = ", ".join(columns)
+    if method == "copy":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cur.copy_expert("COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (table, columns), buffer)
+    elif method == "values":
+        execute_values(cur, "INSERT INTO %s (%s) VALUES %%s" % (table, columns), rows, page_size=len(rows))
+    else:
+        raise ValueError("unknown bulk method: %s" % method)
 
 
 def printTable(conn, cur):
@@ -52,118 +136,295 @@ def printTable(conn, cur):
         print(row)
 
 
-def loadGtfsData(cur, url, counter):
-    positionsDict = common.findStationPositions()
-    gtfsDict = common.preprocessing(url)
-    if gtfsDict:
-        if len(gtfsDict) == 2:
-            gtfsValues = list(gtfsDict.values())[1]
-            if gtfsValues:
-                for i in range(len(gtfsValues)):
-                    res = findStations(gtfsValues, positionsDict, i, counter)
-                    if res:
-                        print(counter)
-                        counter += 1
-                        for station in res:
-                            insertInTable(cur, station)
-    return counter
-
-
-def importGtfsData(cur):
+def extractTrips(url, positionsDict):
+    """
+    Decodes a gtfsrt file and flattens each trip into compact rows
+    :param url: path of the file under the url format
+    :param positionsDict: dictionary returned by common.findStationPositions
+    :return: list of trips, each one being a (tripKey, stops) pair where tripKey is the
+    (trip_id, start_date) of the trip and stops a list of (name, latitude, longitude, time, delay,
+    stopId) tuples
+    """
+    return tripsFromStopTimes(common.extractStopTimes(url), positionsDict)
+
+
+def tripsFromStopTimes(allStopTimes, positionsDict):
+    """
+    Same as extractTrips, for the stop times of a feed that is already decoded
+    """
+    trips = []
+    for stopTimes in allStopTimes:
+        res = findStations(stopTimes, positionsDict, None)
+        if res:
+            trips.append((stopTimes[0][3], [(name, lat, lon, epoch, delay, stopId)
+                                            for name, lat, lon, epoch, _, delay, stopId in map(toRow, res)]))
+    return trips
+
+
+def decodeGtfsFile(url):
+    """
+    Entry point of the import workers
+    """
+    return extractTrips(url, common.findStationPositions())
+
+
+def decodeGtfsPayload(data):
+    """
+    Entry point of the workers decoding the feeds downloaded by the collector
+    :param data: content of a gtfsrt file
+    """
+    return tripsFromStopTimes(common.feedStopTimes(common.parseFeed(data)), common.findStationPositions())
+
+
+def writeTrips(cur, trips, counter, bulk=False, batchSize=BATCH_SIZE, method="copy"):
+    """
+    Numbers the trips decoded by extractTrips and writes their rows into the station table
+    :param bulk: buffer the rows and write them with copyRows instead of one INSERT per row
+    :param batchSize: number of rows buffered before each bulk write
+    :param method: bulk method given to copyRows
+    :return: the updated trip counter and the number of inserted rows
+    """
+    batch = []
+    inserted = 0
+    for _, trip in trips:
+        for name, lat, lon, epoch, delay, stopId in trip:
+            row = (name, lat, lon, epoch, counter, delay, stopId)
+            if bulk:
+                batch.append(row)
+                if len(batch) >= batchSize:
+                    copyRows(cur, batch, method)
+                    inserted += len(batch)
+                    batch = []
+            else:
+                cur.execute(INSERT_STATION, row)
+                inserted += 1
+        counter += 1
+    if batch:
+        copyRows(cur, batch, method)
+        inserted += len(batch)
+    return counter, inserted
+
+
+def upsertTrips(cur, trips, batchSize=BATCH_SIZE, method="copy"):
+    """
+    Writes the trips decoded by extractTrips through the station_staging table. Each trip is
+    identified by its GTFS trip_id and service date, and a stop already stored for a trip is
+    updated with the latest time and delay instead of being inserted again.
+    :return: the IDs of the written trips, the number of written rows, and the statistics buckets
+    of these trips before the update, to give to delaystats.refreshDelayStats
+    """
+    batch = []
+    for (tripId, serviceDate), trip in trips:
+        for name, lat, lon, epoch, delay, stopId in trip:
+            batch.append((name, lat, lon, epoch, delay, stopId, tripId, serviceDate))
+            if len(batch) >= batchSize:
+                copyRows(cur, batch, method, "station_staging", STAGING_COLUMNS)
+                batch = []
+    if batch:
+        copyRows(cur, batch, method, "station_staging", STAGING_COLUMNS)
+    cur.execute("INSERT INTO trip_key (tripId, serviceDate) SELECT DISTINCT tripId, serviceDate "
+                "FROM station_staging ON CONFLICT DO NOTHING")
+    # Statistics buckets of the stored stops of these trips, outdated by the update
+    cur.execute("SELECT DISTINCT k.id FROM station_staging s "
+                "JOIN trip_key k ON k.tripId = s.tripId AND k.serviceDate = s.serviceDate")
+    stale = delaystats.tripBuckets(cur, [row[0] for row in cur.fetchall()])
+    cur.execute("INSERT INTO station (%s) "
+                "SELECT DISTINCT ON (k.id, s.stopId) s.nameStation, s.latStation, s.longStation, s.arrivalTime, "
+                "k.id, s.delay, s.stopId FROM station_staging s "
+                "JOIN trip_key k ON k.tripId = s.tripId AND k.serviceDate = s.serviceDate "
+                "ORDER BY k.id, s.stopId, s.arrivalTime DESC "
+                "ON CONFLICT (trip, stopId) DO UPDATE SET arrivalTime = EXCLUDED.arrivalTime, "
+                "delay = EXCLUDED.delay RETURNING trip" % ", ".join(STATION_COLUMNS))
+    written = cur.rowcount
+    tripIds = sorted({row[0] for row in cur.fetchall()})
+    cur.execute("TRUNCATE station_staging")
+    return tripIds, written, stale
+
+
+def decodeInOrder(decode, urls, workers=1):
+    """
+    Decodes files in a process pool and yields the results in the order of urls. At most
+    2 * workers files are decoded ahead of the consumer, so the decoded rows of a whole backlog
+    never pile up in memory when the decoders are faster than the writer.
+    :param decode: function decoding one url, run in the workers
+    :param workers: number of decoding processes, the files are decoded in this process when 1
+    """
+    if workers <= 1:
+        yield from map(decode, urls)
+        return
+    urls = iter(urls)
+    pending = deque()
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        for url in itertools.islice(urls, 2 * workers):
+            pending.append(executor.submit(decode, url))
+        while pending:
+            result = pending.popleft().result()
+            # The next file is decoded while the consumer writes this one
+            for url in itertools.islice(urls, 1):
+                pending.append(executor.submit(decode, url))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def listGtfsFiles(dataPath="data/"):
+    """
+    :return: the names of all the gtfsrt files of the data folder, in chronological order
+    """
+    return sorted(file for file in os.listdir(dataPath) if file.endswith(".gtfsrt"))
+
+
+def importGtfsData(conn, cur, bulk=False, batchSize=BATCH_SIZE, method="copy", files=None, workers=1,
+                   incremental=False):
+    """
+    Imports the gtfsrt files of the data folder, one transaction per file, and reports the
+    ingestion rate. With several workers, the files are decoded by a process pool while this
+    process stays the only writer; trips are numbered in file order so the counters do not
+    depend on the number of workers.
+    :param files: names of the files to import, defaults to every gtfsrt file of the data folder
+    :param workers: number of decoding processes
+    :param incremental: skip the files recorded in the ledger of ingested files, and upsert the
+    stops with upsertTrips (always in bulk) instead of numbering the trips
+    :return: the number of inserted rows and the elapsed time in seconds
+    """
     dataPath = "data/"
-    files = os.listdir(dataPath)
-    #todo : make for all the gtfsrt files
-    files = [files[i] for i in range(500, 515)]
+    if files is None:
+        files = listGtfsFiles(dataPath)
+    files = [file for file in files if file.endswith(".gtfsrt")]
+    ledger = {}
+    if incremental:
+        schema.createStagingTable(cur)
+        ledger = {name: (size, digest) for name, size, digest in schema.newFiles(cur, dataPath, files)}
+        files = [file for file in files if file in ledger]
     counter = 0
-    for file in files:
-        cwd = os.getcwd()
-        full_path = os.path.join(cwd, dataPath+file)
-        url = 'file://' + full_path
-        if url.endswith(".gtfsrt"):
-            counter = loadGtfsData(cur, url, counter)
-
-
-def findStations(gtfsValues, positionsDict, trip, counter):
-    res = []
-    stops = gtfsValues[trip]['tripUpdate']['stopTimeUpdate']
-    if len(stops) > 1:
-        for i in range(len(stops)):
-            if i == len(stops)-1:
-                res.append([positionsDict[stops[i]['stopId']],
-                            stops[i]['arrival']['time'], counter, 0])
+    partitioned = schema.isPartitioned(cur)
+
+    def writeFile(file, trips):
+        nonlocal counter
+        if partitioned:
+            schema.ensurePartitions(cur, [stop[3] for _, trip in trips for stop in trip])
+        if incremental:
+            tripIds, inserted, stale = upsertTrips(cur, trips, batchSize, method)
+            delaystats.refreshDelayStats(cur, tripIds, stale)
+            schema.recordFile(cur, file, *ledger[file], inserted)
+        else:
+            firstTrip = counter
+            counter, inserted = writeTrips(cur, trips, counter, bulk, batchSize, method)
+            delaystats.refreshDelayStats(cur, range(firstTrip, counter))
+        conn.commit()
+        return inserted
+    return ingestFiles(files, writeFile, workers, dataPath)
 
-            else:
-                if 'departure' not in stops[i] and i > 0:
-                    stops[i]['departure'] = {'delay': stops[i - 1]['departure']['delay'],
-                                             'time': stops[i - 1]['departure']['time']}
-                if 'departure' in stops[i]:
-                    res.append([positionsDict[stops[i]['stopId']],
-                                stops[i]['departure']['time'], counter, stops[i]['departure']['delay']])
 
-        return res
+def ingestFiles(files, writeFile, workers=1, dataPath="data/"):
+    """
+    Decodes gtfsrt files of the data folder in order, hands the trips of each one to the writer,
+    and reports the ingestion rate
+    :param writeFile: function called with the name of each file and its trips, see extractTrips,
+    returning the number of written rows
+    :param workers: number of decoding processes, see decodeInOrder
+    :return: the number of written rows and the elapsed time in seconds
+    """
+    urls = ['file://' + os.path.join(os.getcwd(), dataPath + file) for file in files]
+    totalRows = 0
+    start = time.perf_counter()
+    fileStart = start
+    decoded = decodeInOrder(decodeGtfsFile, urls, workers)
+    try:
+        for file, trips in zip(files, decoded):
+            written = writeFile(file, trips)
+            totalRows += written
+            now = time.perf_counter()
+            reportRate(file, written, now - fileStart)
+            fileStart = now
+    finally:
+        decoded.close()
+    elapsed = time.perf_counter() - start
+    reportRate("total", totalRows, elapsed)
+    return totalRows, elapsed
+
+
+def reportRate(label, rows, seconds):
+    rate = rows / seconds if seconds > 0 else 0
+    print(f"{label}: {rows} rows in {seconds:.2f}s ({rate:.0f} rows/s)")
+
+
+def findStations(stopTimes, positionsDict, counter):
+    """
+    Associates each stop of a trip to its station
+    :param stopTimes: list of (stopId, time, delay, tripKey) tuples from common.extractStopTimes
+    :return: list of [[name, latitude, longitude], time, counter, delay, stopId], or None when
+    the trip has less than two stops
+    """
+    if len(stopTimes) > 1:
+        return [[positionsDict[stopId], epoch, counter, delay, stopId] for stopId, epoch, delay, _ in stopTimes]
 
 
 #main()
 
 
-def retrievePath(conn, trip):
-    cur = conn.cursor()
-    cur.execute("select * from station where trip = %s order by arrivalTime", (trip,))
-    conn.commit()
-    rows = cur.fetchall()
-    cur.close()
-    return rows
+def retrievePath(trip):
+    return dbsession.query("retrievePath", (trip,))
 
 
-def retrieveMean(conn, trip, epochStart, epochEnd):
+def retrieveMean(trip, epochStart, epochEnd):
     """
     Queries the database for the average value of "delay" column,
     order by mean arrival time and grouped for each invidual station
     """
-    cur = conn.cursor()
-    cur.execute("select nameStation, (AVG(delay)/60)::numeric(5,0) from station where trip = %s and arrivalTime > %s and arrivalTime < %s GROUP BY nameStation ORDER BY AVG(arrivalTime)", (trip,epochStart,epochEnd,))
-    conn.commit()
-    rows = cur.fetchall()
-    cur.close()
-    return rows
+    return dbsession.query("retrieveMean", (trip, epochStart, epochEnd))
+
 
+def retrieveDelayStats(trip, epochStart, epochEnd):
+    """
+    Reads the precomputed delay statistics of the trips sharing the stations of a trip
+    :return: rows of (nameStation, mean, p50, p90, max delay in minutes, number of stops) ordered
+    by mean arrival time
+    """
+    return dbsession.query("retrieveDelayStats", (trip, epochStart, epochEnd))
 
 
 
-def retrieveStations(arrivalStation, departureStation):
-    stationDico = {}
-    for station in departureStation:
-        keyTrip = station[-1]
-        if keyTrip in stationDico:
-            stationDico[keyTrip].append(station)
-        else:
-            stationDico[keyTrip] = [station]
-    validDepartureStation = []
-    validArrivalStation = []
-    for station in arrivalStation:
-        keyTrip = station[-1]
-        if keyTrip in stationDico:
-            validDepartureStation.append(stationDico[keyTrip])
-            validArrivalStation.append(station)
-    return validArrivalStation, validDepartureStation
-
-
-def retrieveArrivalStation(conn, station, epoch):
-    cur = conn.cursor()
-    cur.execute("select * from station where nameStation = %s and arrivalTime > %s", (station, epoch,))
-    conn.commit()
-    rows = cur.fetchall()
-    cur.close()
-    return rows
 
+def findTrips(departureStation, arrivalStation, epoch, limit=5):
+    """
+    Finds, in a single query, the next trips that leave departureStation at or after epoch and
+    then stop at arrivalStation
+    :param limit: maximum number of trips
+    :return: list of trips ordered by departure time, each one being the list of its rows
+    ordered by time
+    """
+    trips = []
+    for row in dbsession.query("findTrips", (departureStation, arrivalStation, epoch, limit)):
+        if not trips or trips[-1][0][5] != row[5]:
+            trips.append([])
+        trips[-1].append(row)
+    return trips
 
-def retrieveDepartureStation(conn, station, epoch):
-    cur = conn.cursor()
-    cur.execute("select * from station where nameStation = %s and arrivalTime < %s", (station, epoch,))
-    conn.commit()
-    rows = cur.fetchall()
-    cur.close()
-    return rows
+
+def retrieveActiveTrips(epochStart, epochEnd):
+    """
+    Finds, in a single query, every trip running between two times
+    :return: list of trips, each one being the list of its rows ordered by time
+    """
+    trips = []
+    for row in dbsession.query("activeTrips", (epochStart, epochEnd, dbsession.MAX_STOP_GAP)):
+        if not trips or trips[-1][0][5] != row[5]:
+            trips.append([])
+        trips[-1].append(row)
+    return trips
+
+
+def retrieveArrivalStation(station, epoch):
+    return dbsession.query("retrieveArrivalStation", (station, epoch))
+
+
+def retrieveDepartureStation(station, epoch):
+    return dbsession.query("retrieveDepartureStation", (station, epoch))
 
 
-main()
+if __name__ == "__main__":
+    main()
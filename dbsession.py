@@ -0,0 +1,165 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+"""
+Shared access layer for the read queries of the dashboard. Connections come from one pool per
+process, run read-only in autocommit mode, and the hot queries are prepared once per connection.
+The pool keeps all its connections open (psycopg2 closes the ones above minconn when they are
+given back), so that the prepared statements are not lost.
+The connection parameters are read from the standard PostgreSQL environment variables
+(PGDATABASE, PGUSER, PGPASSWORD, PGHOST, PGPORT), and TRAINDB_POOL_SIZE sets the pool size.
+"""
+
+STATION_SELECT = "select id, nameStation, latStation, longStation, arrivalTime, trip, delay from station"
+
+# Longest time between two consecutive stops of a trip: activeTrips only reads the stops this
+# close to its time window
+MAX_STOP_GAP = 3 * 3600
+
+# Hot queries: name -> (parameter types, query)
+STATEMENTS = {
+    "retrievePath": ("int", STATION_SELECT + " where trip = $1 order by arrivalTime"),
+    "retrieveArrivalStation": ("text, int", STATION_SELECT + " where nameStation = $1 and arrivalTime > $2"),
+    "retrieveDepartureStation": ("text, int", STATION_SELECT + " where nameStation = $1 and arrivalTime < $2"),
+    "retrieveMean": ("int, int, int", "select nameStation, (AVG(delay)/60)::numeric(5,0) from station "
+                                      "where trip = $1 and arrivalTime > $2 and arrivalTime < $3 "
+                                      "GROUP BY nameStation ORDER BY AVG(arrivalTime)"),
+    # Delay statistics of the pattern of trip $1 between $2 and $3, in minutes. Percentiles of
+    # several hours are approximated by the mean of the hourly percentiles weighted by their count
+    "retrieveDelayStats": ("int, int, int",
+                           "select ds.nameStation, (SUM(ds.n * ds.meanDelay) / SUM(ds.n) / 60)::numeric(5,0), "
+                           "(SUM(ds.n * ds.p50) / SUM(ds.n) / 60)::numeric(5,0), "
+                           "(SUM(ds.n * ds.p90) / SUM(ds.n) / 60)::numeric(5,0), "
+                           "(MAX(ds.maxDelay) / 60.0)::numeric(5,0), SUM(ds.n) "
+                           "from trip_pattern p JOIN delay_stats ds ON ds.pattern = p.pattern "
+                           "where p.trip = $1 and ds.hourBucket >= $2 / 3600 and ds.hourBucket <= $3 / 3600 "
+                           "GROUP BY ds.nameStation ORDER BY SUM(ds.n * ds.meanArrival) / SUM(ds.n)"),
+    # Next trips leaving station $1 at or after $3 and reaching station $2 afterwards, with all their
+    # stops. The departures are read in order from station_name_time_idx, until $4 of them match.
+    "findTrips": ("text, text, int, int",
+                  "WITH matches AS (SELECT d.trip, d.arrivalTime AS departureTime FROM station d "
+                  "WHERE d.nameStation = $1 AND d.arrivalTime >= $3 AND EXISTS (SELECT 1 FROM station a "
+                  "WHERE a.trip = d.trip AND a.nameStation = $2 AND a.arrivalTime > d.arrivalTime) "
+                  "ORDER BY d.arrivalTime LIMIT $4) "
+                  "select s.id, s.nameStation, s.latStation, s.longStation, s.arrivalTime, s.trip, s.delay "
+                  "from matches m JOIN station s ON s.trip = m.trip "
+                  "ORDER BY m.departureTime, s.trip, s.arrivalTime"),
+    # Every trip running between $1 and $2, that is with a stop before $2 and a stop after $1,
+    # with all its stops. $3 is MAX_STOP_GAP.
+    "activeTrips": ("int, int, int",
+                    "WITH active AS (SELECT trip FROM station "
+                    "WHERE arrivalTime >= $1 - $3 AND arrivalTime < $2 + $3 "
+                    "GROUP BY trip HAVING MIN(arrivalTime) < $2 AND MAX(arrivalTime) > $1) "
+                    "select s.id, s.nameStation, s.latStation, s.longStation, s.arrivalTime, s.trip, s.delay "
+                    "from active JOIN station s ON s.trip = active.trip "
+                    "ORDER BY s.trip, s.arrivalTime"),
+}
+
+_pool = None
+_lock = threading.Lock()
+# Prepared statement names of each pooled connection
+_prepared = {}
+# busy counts the connections currently borrowed, exhausted the sessions refused because none was left
+_metrics = {"checkouts": 0, "busy": 0, "exhausted": 0, "errors": 0, "prepares": 0, "queries": {}}
+
+
+def connectionParameters():
+    return {
+        "database": os.environ.get("PGDATABASE", "traindb"),
+        "user": os.environ.get("PGUSER", "postgres"),
+        "password": os.environ.get("PGPASSWORD", "password"),
+        "host": os.environ.get("PGHOST", "localhost"),
+        "port": os.environ.get("PGPORT", "5432"),
+    }
+
+
+def getPool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            size = int(os.environ.get("TRAINDB_POOL_SIZE", "4"))
+            _pool = ThreadedConnectionPool(size, size, **connectionParameters())
+        return _pool
+
+
+@contextmanager
+def session():
+    """
+    Borrows a read-only autocommit connection from the pool and gives it back afterwards.
+    A connection that failed is closed instead of being reused. The pool does not wait for a
+    connection: PoolError is raised when they are all borrowed.
+    """
+    pool = getPool()
+    try:
+        conn = pool.getconn()
+    except PoolError:
+        with _lock:
+            _metrics["exhausted"] += 1
+        raise
+    with _lock:
+        _metrics["checkouts"] += 1
+        _metrics["busy"] += 1
+        if conn not in _prepared:
+            conn.set_session(readonly=True, autocommit=True)
+            _prepared[conn] = set()
+    failed = False
+    try:
+        yield conn
+    except psycopg2.Error:
+        failed = True
+        with _lock:
+            _metrics["errors"] += 1
+            _prepared.pop(conn, None)
+        raise
+    finally:
+        pool.putconn(conn, close=failed)
+        with _lock:
+            _metrics["busy"] -= 1
+
+
+def query(name, params):
+    """
+    Runs one of the STATEMENTS with the given parameters, preparing it first on a connection
+    that has not seen it yet
+    :return: the rows of the result
+    """
+    types, sql = STATEMENTS[name]
+    with session() as conn:
+        cur = conn.cursor()
+        if name not in _prepared[conn]:
+            cur.execute("PREPARE %s (%s) AS %s" % (name, types, sql))
+            _prepared[conn].add(name)
+            with _lock:
+                _metrics["prepares"] += 1
+        cur.execute("EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(params))), params)
+        rows = cur.fetchall()
+        cur.close()
+    with _lock:
+        _metrics["queries"][name] = _metrics["queries"].get(name, 0) + 1
+    return rows
+
+
+def poolMetrics():
+    """
+    :return: a snapshot of the pool usage: borrowed and idle connections, checkouts, sessions
+    refused because the pool was exhausted, failed sessions, prepared statements and queries by name
+    """
+    with _lock:
+        metrics = dict(_metrics, queries=dict(_metrics["queries"]))
+        if _pool is not None:
+            metrics["idle"] = _pool.maxconn - metrics["busy"]
+            metrics["maxconn"] = _pool.maxconn
+    return metrics
+
+
+def closePool():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _prepared.clear()
@@ -0,0 +1,79 @@
+from psycopg2.extras import execute_values
+
+"""
+Precomputed delay statistics of the station table, read by the "Average delay for this line"
+button. Trips sharing the same sequence of stations have the same pattern, and the statistics
+are kept per pattern, station and hour. They are refreshed after each imported file, for the
+buckets touched by its trips only, so reading them does not depend on the amount of history.
+"""
+
+HOUR = 3600
+
+
+def createStatsTables(cur):
+    cur.execute("DROP TABLE IF EXISTS trip_pattern;")
+    cur.execute("DROP TABLE IF EXISTS delay_stats;")
+    cur.execute('''CREATE TABLE trip_pattern
+               (trip INT PRIMARY KEY,
+                pattern TEXT);''')
+    cur.execute("CREATE INDEX trip_pattern_pattern_idx ON trip_pattern (pattern)")
+    cur.execute('''CREATE TABLE delay_stats
+               (pattern TEXT,
+                nameStation TEXT,
+                hourBucket INT,
+                n INT,
+                meanDelay FLOAT,
+                p50 FLOAT,
+                p90 FLOAT,
+                maxDelay INT,
+                meanArrival FLOAT,
+                PRIMARY KEY (pattern, nameStation, hourBucket));''')
+    cur.execute("CREATE INDEX delay_stats_pattern_hour_idx ON delay_stats (pattern, hourBucket)")
+
+
+def tripBuckets(cur, trips):
+    """
+    :param trips: IDs of stored trips
+    :return: the (pattern, station, hour) buckets the stored stops of these trips contribute to
+    """
+    cur.execute("SELECT DISTINCT p.pattern, s.nameStation, s.arrivalTime / %s FROM station s "
+                "JOIN trip_pattern p ON p.trip = s.trip WHERE s.trip = ANY(%s)", (HOUR, list(trips)))
+    return cur.fetchall()
+
+
+def refreshDelayStats(cur, trips, stale=()):
+    """
+    Computes the pattern of the given trips, then recomputes every (pattern, station, hour) bucket
+    they contribute to, from all the trips of the same pattern
+    :param trips: IDs of the trips that were just inserted or updated
+    :param stale: buckets returned by tripBuckets before the update. They are recomputed too, since
+    a stop moved to another hour or a trip whose stations changed no longer counts in them, and
+    the ones left without stops are deleted.
+    """
+    trips = list(trips)
+    stale = list(stale)
+    if not trips and not stale:
+        return
+    if trips:
+        cur.execute("INSERT INTO trip_pattern (trip, pattern) "
+                    "SELECT trip, md5(string_agg(nameStation, '>' ORDER BY arrivalTime)) FROM station "
+                    "WHERE trip = ANY(%s) GROUP BY trip "
+                    "ON CONFLICT (trip) DO UPDATE SET pattern = EXCLUDED.pattern", (trips,))
+    cur.execute('''CREATE TEMP TABLE IF NOT EXISTS touched_bucket
+               (pattern TEXT,
+                nameStation TEXT,
+                hourBucket INT);''')
+    cur.execute("TRUNCATE touched_bucket")
+    execute_values(cur, "INSERT INTO touched_bucket (pattern, nameStation, hourBucket) VALUES %s",
+                   tripBuckets(cur, trips) + stale)
+    cur.execute("DELETE FROM delay_stats d USING touched_bucket t WHERE d.pattern = t.pattern "
+                "AND d.nameStation = t.nameStation AND d.hourBucket = t.hourBucket")
+    cur.execute("WITH touched AS (SELECT DISTINCT pattern, nameStation, hourBucket FROM touched_bucket) "
+                "INSERT INTO delay_stats (pattern, nameStation, hourBucket, n, meanDelay, p50, p90, maxDelay, meanArrival) "
+                "SELECT t.pattern, t.nameStation, t.hourBucket, COUNT(*), AVG(s.delay), "
+                "percentile_cont(0.5) WITHIN GROUP (ORDER BY s.delay), "
+                "percentile_cont(0.9) WITHIN GROUP (ORDER BY s.delay), MAX(s.delay), AVG(s.arrivalTime) "
+                "FROM touched t JOIN trip_pattern p ON p.pattern = t.pattern "
+                "JOIN station s ON s.trip = p.trip AND s.nameStation = t.nameStation "
+                "AND s.arrivalTime >= t.hourBucket * %s AND s.arrivalTime < (t.hourBucket + 1) * %s "
+                "GROUP BY t.pattern, t.nameStation, t.hourBucket", (HOUR, HOUR))
@@ -0,0 +1,145 @@
+import json
+import os
+import shutil
+import weakref
+from functools import lru_cache
+
+import networkx as nx
+import numpy as np
+import osmnx as ox
+
+"""
+Binary cache of the railway graph. Parsing the graphml file is the slowest part of the dashboard
+startup, so the parts of the graph used by the trajectories (node coordinates and edge lengths)
+are kept as NumPy arrays in a folder next to it, one .npy file per array, memory-mapped when
+loaded. The cache is rebuilt when the graphml file changes.
+"""
+
+CACHE_SUFFIX = '.arrays'
+ARRAYS = ('nodeIds', 'x', 'y', 'sources', 'targets', 'lengths')
+
+# RailGraph of each osmnx graph built by loadGraph
+railGraphs = weakref.WeakKeyDictionary()
+
+
+class RailGraph:
+    """
+    Columns of the nodes and edges of the graph: node i has the OSM ID nodeIds[i] and the
+    coordinates (x[i], y[i]); edge j goes from node sources[j] to node targets[j], given as
+    positions in nodeIds, and is lengths[j] meters long.
+    """
+
+    def __init__(self, nodeIds, x, y, sources, targets, lengths, crs):
+        self.nodeIds = nodeIds
+        self.x = x
+        self.y = y
+        self.sources = sources
+        self.targets = targets
+        self.lengths = lengths
+        self.crs = crs
+
+    def __len__(self):
+        return len(self.nodeIds)
+
+    def toNetworkx(self):
+        """
+        :return: the MultiDiGraph of the nodes and edges, as used by osmnx
+        """
+        G = nx.MultiDiGraph(crs=self.crs)
+        ids = self.nodeIds.tolist()
+        G.add_nodes_from((node, {'x': x, 'y': y}) for node, x, y in zip(ids, self.x.tolist(), self.y.tolist()))
+        G.add_edges_from((ids[u], ids[v], {'length': length}) for u, v, length
+                         in zip(self.sources.tolist(), self.targets.tolist(), self.lengths.tolist()))
+        return G
+
+
+def fromNetworkx(G):
+    """
+    :return: the RailGraph of an osmnx graph
+    """
+    nodes = list(G.nodes)
+    positions = {node: i for i, node in enumerate(nodes)}
+    edges = list(G.edges(data='length', default=0.0))
+    return RailGraph(np.array(nodes, dtype=np.int64),
+                     np.array([G.nodes[node]['x'] for node in nodes], dtype=np.float64),
+                     np.array([G.nodes[node]['y'] for node in nodes], dtype=np.float64),
+                     np.array([positions[u] for u, v, length in edges], dtype=np.int32),
+                     np.array([positions[v] for u, v, length in edges], dtype=np.int32),
+                     np.array([length for u, v, length in edges], dtype=np.float64),
+                     str(G.graph.get('crs', 'epsg:4326')))
+
+
+def downloadGraph(graphPath):
+    """
+    Downloads the railway network of Belgium from OpenStreetMap and saves it as graphml
+    """
+    G = ox.graph_from_place("Belgium", custom_filter='["railway"]')
+    ox.save_graphml(G, graphPath)
+    return G
+
+
+def readCache(cachePath, signature):
+    try:
+        with open(os.path.join(cachePath, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('signature') != list(signature):
+            return None
+        arrays = [np.load(os.path.join(cachePath, name + '.npy'), mmap_mode='r') for name in ARRAYS]
+    except (OSError, ValueError):
+        return None
+    return RailGraph(*arrays, meta['crs'])
+
+
+def writeCache(cachePath, signature, graph):
+    # Written in a temporary folder first, so another process never reads a partial cache
+    tmpPath = "%s.%d" % (cachePath, os.getpid())
+    os.makedirs(tmpPath, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(tmpPath, name + '.npy'), getattr(graph, name))
+    with open(os.path.join(tmpPath, 'meta.json'), 'w') as f:
+        json.dump({'signature': list(signature), 'crs': graph.crs}, f)
+    shutil.rmtree(cachePath, ignore_errors=True)
+    os.rename(tmpPath, cachePath)
+
+
+@lru_cache(maxsize=None)
+def loadRailGraph(graphPath):
+    """
+    Returns the arrays of a graphml file, from the binary cache when it is still valid. The
+    graph is downloaded first when the graphml file does not exist.
+    :return: the RailGraph, memoized for the whole process
+    """
+    if not os.path.exists(graphPath):
+        downloadGraph(graphPath)
+    stat = os.stat(graphPath)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cachePath = graphPath + CACHE_SUFFIX
+    graph = readCache(cachePath, signature)
+    if graph is None:
+        graph = fromNetworkx(ox.load_graphml(graphPath))
+        try:
+            writeCache(cachePath, signature, graph)
+        except OSError:
+            pass
+    return graph
+
+
+@lru_cache(maxsize=None)
+def loadGraph(graphPath):
+    """
+    :return: the osmnx graph of a graphml file, rebuilt from the binary cache, memoized for the
+    whole process
+    """
+    graph = loadRailGraph(graphPath)
+    G = graph.toNetworkx()
+    railGraphs[G] = graph
+    return G
+
+
+def railGraphOf(G):
+    """
+    :return: the RailGraph of an osmnx graph, without conversion when G comes from loadGraph
+    """
+    if G not in railGraphs:
+        railGraphs[G] = fromNetworkx(G)
+    return railGraphs[G]
@@ -1,38 +1,279 @@
-import itertools
+import os
+import pickle
+import threading
+import weakref
+
+import numpy as np
 import osmnx as ox
-from geopy.distance import distance
 
+import graphcache
+import routecache
+import routing
+import stations
 
-def retrieveTripCoordinates(startTime, trip, G):
+GRAPH_PATH = 'railwayGraph.graphml'
+SNAP_SUFFIX = '.snap'
+EARTH_RADIUS = 6371008.8
+TRAJECTORY_DTYPE = np.dtype([('lat', np.float64), ('lon', np.float64), ('t', np.float64)])
+
+# Snapping tables, route caches and routing engines of the graphs already used by this process,
+# built once under _lock by the first thread asking for them
+snapTables = weakref.WeakKeyDictionary()
+routeCaches = weakref.WeakKeyDictionary()
+engines = weakref.WeakKeyDictionary()
+# graphml file of each graph returned by loadGraph
+graphPaths = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def loadGraph(graphPath=GRAPH_PATH):
+    """
+    :return: the railway graph, loaded from its binary cache, see graphcache
+    """
+    G = graphcache.loadGraph(graphPath)
+    graphPaths[G] = graphPath
+    return G
+
+
+def graphPathOf(G):
+    """
+    :return: the graphml file G was loaded from, GRAPH_PATH when it does not come from loadGraph
+    """
+    return graphPaths.get(G, GRAPH_PATH)
+
+
+def fileSignature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def buildSnapTable(G, index):
+    """
+    Snaps every station of the index to its nearest graph node with a single vectorized query
+    :param index: the stations.StationIndex
+    :return: dictionary with the (latitude, longitude) of a station as key and its node as value
+    """
+    nodes = ox.nearest_nodes(G, list(index.longitudes), list(index.latitudes))
+    return {(lat, lon): node for lat, lon, node in zip(index.latitudes, index.longitudes, nodes)}
+
+
+def loadSnapTable(G, graphPath=None):
+    """
+    Returns the snapping table of G. It is saved next to the graphml file and rebuilt when
+    either the graph or stops.txt changes.
+    :param graphPath: location of the graphml file G was loaded from, see graphPathOf
+    """
+    table = snapTables.get(G)
+    if table is None:
+        with _lock:
+            if G not in snapTables:
+                snapTables[G] = readSnapTable(G, graphPath or graphPathOf(G))
+            table = snapTables[G]
+    return table
+
+
+def readSnapTable(G, graphPath):
+    """
+    :return: the snapping table saved next to the graphml file, built and saved again when outdated
+    """
+    signature = (fileSignature(graphPath), fileSignature(stations.STOPS_PATH))
+    snapPath = graphPath + SNAP_SUFFIX
+    table = None
+    try:
+        with open(snapPath, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['signature'] == signature:
+            table = cached['table']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+        pass
+    if table is None:
+        table = buildSnapTable(G, stations.loadStationIndex())
+        try:
+            writeSnapTable(snapPath, signature, table)
+        except OSError:
+            pass
+    return table
+
+
+def writeSnapTable(snapPath, signature, table):
+    # Written under a temporary name first, so another process never reads a partial file
+    tmpPath = "%s.%d" % (snapPath, os.getpid())
+    with open(tmpPath, 'wb') as f:
+        pickle.dump({'signature': signature, 'table': table}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpPath, snapPath)
 
 
-    for i in range(len(trip)-1):
-        routeNodes = extractCoordinates(G, trip[i], trip[i+1])
-        startTime = writeInFile(routeNodes, startTime, trip[i], trip[i+1])
+def snapCoordinates(G, lat, lon):
+    """
+    :return: the graph node nearest to the coordinates of a station
+    """
+    node = loadSnapTable(G).get((lat, lon))
+    if node is None:
+        node = ox.nearest_nodes(G, lon, lat)
+    return node
 
 
-def extractCoordinates(G, station1, station2):
-    station1 = ox.nearest_nodes(G, float(station1[3]), float(station1[2]))
-    station2 = ox.nearest_nodes(G, float(station2[3]), float(station2[2]))
-    route = ox.shortest_path(G, station1, station2)
-    routeNodes = [(G.nodes[node]['y'], G.nodes[node]['x']) for node in route]
-    routeNodes = [key for key, group in itertools.groupby(routeNodes)]
-    distances = 0
-    if len(routeNodes) > 1:
-        for i in range(len(routeNodes) - 1):
-            distances += distance([routeNodes[i][0], routeNodes[i][1]],
-                                  [routeNodes[i + 1][0], routeNodes[i + 1][1]]).m
+def snapStation(G, station):
+    """
+    :param station: row of the station table
+    :return: the graph node nearest to the station
+    """
+    return snapCoordinates(G, float(station[2]), float(station[3]))
 
-    return routeNodes
 
+def loadRouteCache(G, graphPath=None):
+    """
+    Returns the route cache of G, stored next to the graphml file it was loaded from
+    :param graphPath: location of the graphml file, see graphPathOf
+    """
+    cache = routeCaches.get(G)
+    if cache is None:
+        with _lock:
+            if G not in routeCaches:
+                graphPath = graphPath or graphPathOf(G)
+                routeCaches[G] = routecache.RouteCache(graphPath + routecache.ROUTES_SUFFIX, fileSignature(graphPath))
+            cache = routeCaches[G]
+    return cache
 
-def writeInFile(routeNodes, startTime, station1, station2):
-    tripTime = station2[4] - station1[4]
-    for i in range(len(routeNodes)):
-        totalTime = tripTime / len(routeNodes)
-        startTime += totalTime
-        with open('travels.txt', 'a+') as travels:
-            travels.write(f"{routeNodes[i][1]},{routeNodes[i][0]},{int(startTime)}\n")
-            travels.close()
 
-    return startTime
+def loadEngine(G):
+    """
+    Returns the routing engine of G, built once per graph
+    """
+    engine = engines.get(G)
+    if engine is None:
+        with _lock:
+            if G not in engines:
+                engines[G] = routing.RoutingEngine(graphcache.railGraphOf(G))
+            engine = engines[G]
+    return engine
+
+
+def routesBetween(G, pairs):
+    """
+    Returns the coordinates of the shortest path of each pair of nodes. The pairs found in the
+    route cache are read from it, the others are computed together by the routing engine.
+    :param pairs: list of (node1, node2)
+    :return: list of (n, 2) arrays of latitudes and longitudes without consecutive duplicates
+    """
+    cache = loadRouteCache(G)
+    routes = [cache.get(node1, node2) for node1, node2 in pairs]
+    missing = list(dict.fromkeys(pair for pair, routeNodes in zip(pairs, routes) if routeNodes is None))
+    if missing:
+        computed = {}
+        for pair, routeNodes in zip(missing, loadEngine(G).routes(missing)):
+            computed[pair] = dropRepeats(routeNodes)
+            cache.put(pair[0], pair[1], computed[pair])
+        routes = [computed[pair] if routeNodes is None else routeNodes for pair, routeNodes in zip(pairs, routes)]
+    return routes
+
+
+def routeBetween(G, node1, node2):
+    """
+    Returns the coordinates of the shortest path between two nodes, see routesBetween
+    """
+    return routesBetween(G, [(node1, node2)])[0]
+
+
+def dropRepeats(routeNodes):
+    """
+    :return: the (n, 2) array of coordinates without its consecutive duplicates
+    """
+    if len(routeNodes) < 2:
+        return routeNodes
+    keep = np.ones(len(routeNodes), dtype=bool)
+    keep[1:] = np.any(routeNodes[1:] != routeNodes[:-1], axis=1)
+    return routeNodes[keep]
+
+
+def segmentLengths(routeNodes):
+    """
+    Haversine length of every segment of a route, computed in one vectorized call
+    :param routeNodes: (n, 2) array of latitudes and longitudes in degrees
+    :return: array of the n - 1 segment lengths in meters
+    """
+    lat = np.radians(routeNodes[:, 0])
+    lon = np.radians(routeNodes[:, 1])
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def interpolateTimes(routeNodes, startTime, endTime):
+    """
+    Gives a timestamp to each node of a route, proportionally to the distance travelled since
+    its first node. A route without length is spread evenly over the time instead.
+    :return: array of the n timestamps, the last one being endTime
+    """
+    n = len(routeNodes)
+    cumulative = np.cumsum(segmentLengths(routeNodes)) if n > 1 else np.empty(0)
+    if n > 1 and cumulative[-1] > 0:
+        fractions = np.concatenate(([0.0], cumulative / cumulative[-1]))
+    else:
+        fractions = np.arange(1, n + 1) / max(n, 1)
+    return startTime + (endTime - startTime) * fractions
+
+
+def interpolateRoutes(coords, counts, startTimes, endTimes):
+    """
+    Vectorized interpolateTimes over many routes stored one after the other
+    :param coords: (n, 2) array of the latitudes and longitudes of all the routes
+    :param counts: number of nodes of each route
+    :param startTimes: time of the first node of each route
+    :param endTimes: time of the last node of each route
+    :return: array of the n timestamps
+    """
+    routeOf = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    lengths = np.zeros(len(coords))
+    if len(coords) > 1:
+        lengths[1:] = segmentLengths(coords)
+    # No distance is travelled between the last node of a route and the first node of the next one
+    lengths[starts[counts > 0]] = 0
+    cumulative = np.cumsum(lengths)
+    travelled = cumulative - cumulative[starts[routeOf]]
+    totals = cumulative[starts[routeOf] + counts[routeOf] - 1] - cumulative[starts[routeOf]]
+    even = (np.arange(len(coords)) - starts[routeOf] + 1) / counts[routeOf]
+    fractions = np.where(totals > 0, travelled / np.where(totals > 0, totals, 1), even)
+    return startTimes[routeOf] + (endTimes - startTimes)[routeOf] * fractions
+
+
+def retrieveTrajectories(trips, G):
+    """
+    Builds the trajectories of many trips at once: the routes between all their pairs of
+    consecutive stations are computed in one batch, and all the timestamps in one vectorized call
+    :param trips: list of trips, each one being its rows of the station table ordered by time
+    :return: list of structured arrays of TRAJECTORY_DTYPE, one per trip
+    """
+    if not trips:
+        return []
+    pairs, startTimes, endTimes, tripOf = [], [], [], []
+    for i, trip in enumerate(trips):
+        for j in range(len(trip) - 1):
+            pairs.append((snapStation(G, trip[j]), snapStation(G, trip[j+1])))
+            startTimes.append(trip[j][4])
+            endTimes.append(trip[j+1][4])
+            tripOf.append(i)
+    routes = routesBetween(G, pairs)
+    counts = np.array([len(routeNodes) for routeNodes in routes], dtype=np.int64)
+    trajectories = np.empty(int(counts.sum()), dtype=TRAJECTORY_DTYPE)
+    if len(trajectories):
+        coords = np.concatenate([routeNodes for routeNodes in routes if len(routeNodes)])
+        trajectories['lat'] = coords[:, 0]
+        trajectories['lon'] = coords[:, 1]
+        trajectories['t'] = interpolateRoutes(coords, counts, np.array(startTimes, dtype=np.float64),
+                                              np.array(endTimes, dtype=np.float64))
+    nodesPerTrip = np.bincount(np.array(tripOf, dtype=np.int64), weights=counts, minlength=len(trips))
+    return np.split(trajectories, np.cumsum(nodesPerTrip.astype(np.int64))[:-1])
+
+
+def retrieveTripCoordinates(startTime, trip, G):
+    """
+    Builds the trajectory of a trip in memory: the route between each pair of consecutive
+    stations, with a timestamp for each node
+    :param startTime: time of the first station
+    :param trip: rows of the station table, ordered by time
+    :return: structured array of TRAJECTORY_DTYPE, one record per route node
+    """
+    trajectory = retrieveTrajectories([trip], G)[0]
+    trajectory['t'] += startTime - trip[0][4]
+    return trajectory
@@ -0,0 +1,128 @@
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+"""
+Cache of the route geometries between two graph nodes. Recently used routes are kept in memory,
+and every route is stored in a SQLite file next to the graphml file so it survives between
+dashboard sessions. The file is emptied when the graph changes.
+Usage: python routecache.py warm
+"""
+
+ROUTES_SUFFIX = '.routes.sqlite'
+MEMORY_SIZE = 4096
+
+
+class RouteCache:
+    def __init__(self, path, signature, maxsize=MEMORY_SIZE):
+        """
+        :param path: location of the SQLite file
+        :param signature: signature of the graph, the stored routes are dropped when it changes
+        :param maxsize: number of routes kept in memory
+        """
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS route (nodeA INTEGER, nodeB INTEGER, coords BLOB, "
+                        "PRIMARY KEY (nodeA, nodeB))")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        if row is None or row[0] != repr(signature):
+            self.db.execute("DELETE FROM route")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (repr(signature),))
+        self.db.commit()
+
+    def get(self, nodeA, nodeB):
+        """
+        :return: the (n, 2) array of the latitudes and longitudes of the route, or None when it is
+        not cached
+        """
+        key = (nodeA, nodeB)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            row = self.db.execute("SELECT coords FROM route WHERE nodeA = ? AND nodeB = ?", key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            coords = decodeCoords(row[0])
+            self.remember(key, coords)
+            return coords
+
+    def put(self, nodeA, nodeB, coords):
+        key = (nodeA, nodeB)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO route VALUES (?, ?, ?)", (nodeA, nodeB, encodeCoords(coords)))
+            self.db.commit()
+            self.remember(key, coords)
+
+    def remember(self, key, coords):
+        self.memory[key] = coords
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def encodeCoords(coords):
+    return np.ascontiguousarray(coords, dtype=np.float64).tobytes()
+
+
+def decodeCoords(blob):
+    return np.frombuffer(blob, dtype=np.float64).reshape(-1, 2)
+
+
+def stationPairs(conn):
+    """
+    Queries the distinct pairs of consecutive stations of the trips of the station table
+    :return: list of (latitude1, longitude1, latitude2, longitude2)
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT latStation, longStation, nextLat, nextLong FROM "
+                "(SELECT latStation, longStation, LEAD(latStation) OVER w AS nextLat, "
+                "LEAD(longStation) OVER w AS nextLong FROM station "
+                "WINDOW w AS (PARTITION BY trip ORDER BY arrivalTime)) pairs "
+                "WHERE nextLat IS NOT NULL")
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+def warm():
+    """
+    Computes and stores the route of every pair of consecutive stations found in the station table
+    """
+    import db
+    import osm
+
+    G = osm.loadGraph()
+    conn, cur = db.connectToDB()
+    cur.close()
+    pairs = stationPairs(conn)
+    conn.close()
+    # Routed together, with one Dijkstra per distinct origin, see osm.routesBetween
+    osm.routesBetween(G, [(osm.snapCoordinates(G, lat1, lon1), osm.snapCoordinates(G, lat2, lon2))
+                          for lat1, lon1, lat2, lon2 in pairs])
+    print(f"{len(pairs)} station pairs warmed")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["warm"]:
+        warm()
+    else:
+        print("usage: python routecache.py warm")
+        sys.exit(1)
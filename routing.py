@@ -0,0 +1,72 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+"""
+Shortest paths on the railway graph, computed with the Dijkstra of scipy.sparse.csgraph on a
+compressed sparse row matrix instead of the NetworkX dictionaries. The matrix is built once from
+the arrays of graphcache, and the routes of a whole trip are computed in one call: a single
+Dijkstra per distinct origin reaches every destination asked from it.
+"""
+
+# Edges without length would be dropped from the sparse matrix
+MIN_LENGTH = 1e-6
+# Number of origins searched together, each one keeps two arrays of the size of the graph
+ORIGIN_BATCH = 64
+
+
+class RoutingEngine:
+    def __init__(self, graph):
+        """
+        :param graph: the graphcache.RailGraph to route on
+        """
+        sources = np.asarray(graph.sources)
+        targets = np.asarray(graph.targets)
+        lengths = np.asarray(graph.lengths)
+        # Keep the shortest of the parallel edges between two nodes
+        order = np.lexsort((lengths, targets, sources))
+        sources, targets, lengths = sources[order], targets[order], lengths[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        self.matrix = csr_matrix((np.maximum(lengths[first], MIN_LENGTH), (sources[first], targets[first])),
+                                 shape=(len(graph), len(graph)))
+        self.positions = {node: i for i, node in enumerate(graph.nodeIds.tolist())}
+        self.latitudes = np.asarray(graph.y)
+        self.longitudes = np.asarray(graph.x)
+
+    def paths(self, pairs):
+        """
+        :param pairs: list of (origin, destination) OSM node IDs
+        :return: for each pair, the array of the positions of the nodes of its shortest path,
+        empty when the destination cannot be reached
+        """
+        pairs = [(self.positions[origin], self.positions[destination]) for origin, destination in pairs]
+        origins = sorted({origin for origin, _ in pairs})
+        predecessors = {}
+        for i in range(0, len(origins), ORIGIN_BATCH):
+            batch = origins[i:i + ORIGIN_BATCH]
+            _, found = dijkstra(self.matrix, directed=True, indices=batch, return_predecessors=True)
+            predecessors.update(zip(batch, found))
+        return [walkBack(predecessors[origin], origin, destination) for origin, destination in pairs]
+
+    def routes(self, pairs):
+        """
+        :param pairs: list of (origin, destination) OSM node IDs
+        :return: for each pair, the (n, 2) array of the latitudes and longitudes of its shortest path
+        """
+        return [np.column_stack((self.latitudes[path], self.longitudes[path])) for path in self.paths(pairs)]
+
+
+def walkBack(predecessors, origin, destination):
+    """
+    Follows the predecessors found by the Dijkstra from the destination back to the origin
+    :return: the array of the positions of the nodes from origin to destination
+    """
+    path = [destination]
+    node = destination
+    while node != origin:
+        node = predecessors[node]
+        if node < 0:
+            return np.empty(0, dtype=np.int64)
+        path.append(node)
+    return np.array(path[::-1], dtype=np.int64)
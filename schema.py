@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+import dbsession
+import stations
+
+"""
+Indexes and partitions of the station table, and the tables of the incremental ingestion.
+The stops carry their numerical GTFS stop ID, which identifies a stop within a trip, while the
+queries keep reading the stations by name through station_name_time_idx.
+The station table can be partitioned by service day (UTC days of arrivalTime) when it is
+created, see db.createTable; migrate upgrades an existing, non-partitioned table in place.
+The incremental ingestion needs a non-partitioned table, since PostgreSQL cannot enforce the
+uniqueness of (trip, stopId) across partitions.
+Usage: python schema.py migrate|explain
+"""
+
+DAY = 86400
+
+INDEXES = {
+    "station_name_time_idx": "station (nameStation, arrivalTime)",
+    "station_trip_time_idx": "station (trip, arrivalTime)",
+    "station_time_idx": "station (arrivalTime, trip)",
+}
+
+
+def createIndexes(cur):
+    for name, target in INDEXES.items():
+        cur.execute("CREATE INDEX IF NOT EXISTS %s ON %s" % (name, target))
+
+
+def isPartitioned(cur):
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'station'::regclass)")
+    return cur.fetchone()[0]
+
+
+def ensurePartitions(cur, epochs):
+    """
+    Creates the missing daily partitions of a partitioned station table
+    :param epochs: times of the rows about to be inserted
+    """
+    for day in sorted({int(epoch) // DAY for epoch in epochs}):
+        name = "station_" + datetime.fromtimestamp(day * DAY, tz=timezone.utc).strftime("%Y%m%d")
+        cur.execute("CREATE TABLE IF NOT EXISTS %s PARTITION OF station FOR VALUES FROM (%d) TO (%d)"
+                    % (name, day * DAY, (day + 1) * DAY))
+
+
+def dropIngestionTables(cur):
+    cur.execute("DROP TABLE IF EXISTS ingested_file;")
+    cur.execute("DROP TABLE IF EXISTS trip_key;")
+
+
+def ingestionReady(cur):
+    cur.execute("SELECT to_regclass('ingested_file') IS NOT NULL")
+    return cur.fetchone()[0]
+
+
+def createIngestionTables(cur):
+    """
+    Creates the ledger of the ingested files, the table giving an integer ID to each
+    (GTFS trip_id, service date) pair, and the unique index used to upsert the stops of a trip
+    """
+    cur.execute('''CREATE TABLE IF NOT EXISTS ingested_file
+               (name TEXT PRIMARY KEY,
+                size BIGINT,
+                sha256 TEXT,
+                rows INT,
+                ingestedAt TIMESTAMP DEFAULT now());''')
+    cur.execute("CREATE INDEX IF NOT EXISTS ingested_file_sha256_idx ON ingested_file (sha256)")
+    cur.execute('''CREATE TABLE IF NOT EXISTS trip_key
+               (id SERIAL PRIMARY KEY,
+                tripId TEXT,
+                serviceDate TEXT,
+                UNIQUE (tripId, serviceDate));''')
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS station_trip_stop_key ON station (trip, stopId)")
+
+
+def createStagingTable(cur):
+    cur.execute('''CREATE TEMP TABLE IF NOT EXISTS station_staging
+               (nameStation TEXT,
+                latStation FLOAT,
+                longStation FLOAT,
+                arrivalTime INT,
+                delay INT,
+                stopId INT,
+                tripId TEXT,
+                serviceDate TEXT);''')
+
+
+def fileDigest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def newFiles(cur, dataPath, files):
+    """
+    Compares the files with the ledger. A file is skipped when a file with the same name and
+    size, or with the same content, was already ingested.
+    :return: list of (name, size, sha256) of the files to ingest
+    """
+    cur.execute("SELECT name, size, sha256 FROM ingested_file")
+    known = {}
+    digests = set()
+    for name, size, digest in cur.fetchall():
+        known[name] = (size, digest)
+        digests.add(digest)
+    result = []
+    for file in files:
+        path = os.path.join(dataPath, file)
+        size = os.path.getsize(path)
+        if file in known and known[file][0] == size:
+            continue
+        digest = fileDigest(path)
+        if digest not in digests:
+            result.append((file, size, digest))
+    return result
+
+
+def recordFile(cur, name, size, digest, rows):
+    cur.execute("INSERT INTO ingested_file (name, size, sha256, rows) VALUES (%s, %s, %s, %s) "
+                "ON CONFLICT (name) DO UPDATE SET size = EXCLUDED.size, sha256 = EXCLUDED.sha256, "
+                "rows = EXCLUDED.rows, ingestedAt = now()", (name, size, digest, rows))
+
+
+def migrate(cur):
+    """
+    Brings an existing station table to the current schema: stopId column filled from the
+    station names, and composite indexes of the hot queries
+    """
+    cur.execute("ALTER TABLE station ADD COLUMN IF NOT EXISTS stopId INT")
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS stop_name (id INT, name TEXT)")
+    index = stations.loadStationIndex()
+    execute_values(cur, "INSERT INTO stop_name (id, name) VALUES %s",
+                   [(int(stopId), name) for stopId, name in zip(index.stopIds, index.names)])
+    cur.execute("UPDATE station SET stopId = stop_name.id FROM stop_name "
+                "WHERE station.stopId IS NULL AND station.nameStation = stop_name.name")
+    cur.execute("DROP TABLE stop_name")
+    # Left by earlier versions, no query reads them
+    cur.execute("DROP INDEX IF EXISTS station_stop_time_idx")
+    cur.execute("DROP TABLE IF EXISTS stop")
+    createIndexes(cur)
+    cur.execute("ANALYZE station")
+
+
+def planNodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from planNodes(child)
+
+
+def checkQueryPlans(cur):
+    """
+    Runs EXPLAIN on the hot queries of dbsession with parameters taken from an existing row,
+    and checks that none of them reads the station table with a sequential scan
+    :return: dictionary with the name of each query as key and the list of its scans as value
+    """
+    cur.execute("SELECT nameStation, arrivalTime, trip FROM station LIMIT 1")
+    row = cur.fetchone()
+    if row is None:
+        raise RuntimeError("the station table is empty")
+    name, epoch, trip = row
+    params = {
+        "retrievePath": (trip,),
+        "retrieveArrivalStation": (name, epoch),
+        "retrieveDepartureStation": (name, epoch),
+        "retrieveMean": (trip, epoch - DAY, epoch + DAY),
+        "findTrips": (name, name, epoch - DAY, 5),
+        "activeTrips": (epoch - 3600, epoch + 3600, dbsession.MAX_STOP_GAP),
+    }
+    scans = {}
+    for statement, (types, sql) in dbsession.STATEMENTS.items():
+        if statement not in params:
+            continue
+        cur.execute("PREPARE explain_%s (%s) AS %s" % (statement, types, sql))
+        cur.execute("EXPLAIN (FORMAT JSON) EXECUTE explain_%s (%s)"
+                    % (statement, ", ".join(["%s"] * len(params[statement]))), params[statement])
+        plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        cur.execute("DEALLOCATE explain_%s" % statement)
+        scans[statement] = [(node["Node Type"], node.get("Relation Name"))
+                            for node in planNodes(plan[0]["Plan"]) if "Relation Name" in node]
+    return scans
+
+
+def main(command):
+    import db
+
+    conn, cur = db.connectToDB()
+    if command == "migrate":
+        migrate(cur)
+        conn.commit()
+    scans = checkQueryPlans(cur)
+    ok = True
+    for statement, nodes in scans.items():
+        sequential = [relation for nodeType, relation in nodes if nodeType == "Seq Scan"]
+        ok = ok and not sequential
+        print(f"{statement.ljust(26)} {'SEQ SCAN' if sequential else 'ok'}  {nodes}")
+    cur.close()
+    conn.close()
+    return ok
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] not in (["migrate"], ["explain"]):
+        print("usage: python schema.py migrate|explain")
+        sys.exit(1)
+    sys.exit(0 if main(sys.argv[1]) else 1)
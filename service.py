@@ -0,0 +1,275 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from aiohttp import web
+
+import osm
+import storage
+import trainindex
+import visualization
+from stations import loadStationIndex
+
+"""
+Headless HTTP API of the dashboard: trip search, station list, delay statistics and trajectories
+as GeoJSON. One process serves many clients: the railway graph is loaded once and shared, the
+queries go through the storage backend (the connection pool of dbsession for PostgreSQL), and
+the blocking work runs in a thread pool of the same size as the connection pool.
+Responses are cached for CACHE_TTL seconds, and concurrent identical requests share one
+computation.
+Usage: python service.py [port]
+
+    GET /stations
+    GET /trips?from=<station>&to=<station>&time=<epoch>[&limit=5]
+    GET /delays?from=<station>&to=<station>&time=<epoch>[&start=<epoch>&end=<epoch>]
+    GET /trajectory?from=<station>&to=<station>&time=<epoch>
+    GET /live?start=<epoch>&end=<epoch>
+    GET /trains/viewport?bbox=<min lon>,<min lat>,<max lon>,<max lat>&time=<epoch>
+    GET /trains/nearest?lat=<lat>&lon=<lon>&time=<epoch>[&k=5]
+    GET /metrics
+"""
+
+PORT = 8081
+CACHE_SIZE = 1024
+CACHE_TTL = 60
+# Train indexes kept in memory, one per hour
+INDEX_COUNT = 4
+
+
+class ResponseCache:
+    """
+    Recently computed response bodies, by request. A request arriving while the same request is
+    being computed waits for that computation instead of starting its own.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key, compute):
+        """
+        :param compute: coroutine function computing the body when it is not cached
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if key in self.pending:
+            self.hits += 1
+            return await asyncio.shield(self.pending[key])
+        self.misses += 1
+        future = asyncio.ensure_future(compute())
+        self.pending[key] = future
+        try:
+            body = await asyncio.shield(future)
+        finally:
+            del self.pending[key]
+        self.entries[key] = (time.monotonic() + self.ttl, body)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return body
+
+
+def integer(request, name, default=None):
+    value = request.query.get(name)
+    if value is None:
+        if default is None:
+            raise web.HTTPBadRequest(text="missing parameter: %s" % name)
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text="%s must be an integer" % name)
+
+
+def text(request, name):
+    value = request.query.get(name)
+    if not value:
+        raise web.HTTPBadRequest(text="missing parameter: %s" % name)
+    return value
+
+
+def number(value):
+    return None if value is None else int(value)
+
+
+def stopDict(row):
+    return {"id": row[0], "station": row[1], "lat": float(row[2]), "lon": float(row[3]),
+            "time": int(row[4]), "trip": row[5], "delay": int(row[6])}
+
+
+def dayLimits(epoch):
+    day = datetime.fromtimestamp(epoch)
+    return (int(datetime(day.year, day.month, day.day, 0, 0).timestamp()),
+            int(datetime(day.year, day.month, day.day, 23, 59).timestamp()))
+
+
+async def cached(request, compute, contentType="application/json"):
+    """
+    Answers a request from the cache, or runs compute() in the thread pool
+    :param compute: function returning the body of the response as text
+    """
+    app = request.app
+    key = (request.path, tuple(sorted(request.query.items())))
+
+    async def run():
+        return await asyncio.get_running_loop().run_in_executor(app["executor"], compute)
+
+    body = await app["cache"].get(key, run)
+    return web.Response(text=body, content_type=contentType)
+
+
+async def stationList(request):
+    return web.json_response(request.app["stations"])
+
+
+async def trips(request):
+    departure, arrival = text(request, "from"), text(request, "to")
+    epoch, limit = integer(request, "time"), integer(request, "limit", 5)
+
+    def compute():
+        found = storage.getBackend().findTrips(departure, arrival, epoch, limit)
+        return json.dumps([[stopDict(row) for row in trip] for trip in found])
+    return await cached(request, compute)
+
+
+async def delays(request):
+    departure, arrival = text(request, "from"), text(request, "to")
+    epoch = integer(request, "time")
+    epochStart, epochEnd = dayLimits(epoch)
+    epochStart, epochEnd = integer(request, "start", epochStart), integer(request, "end", epochEnd)
+
+    def compute():
+        rows = visualization.meanDelays(departure, arrival, epoch, epochStart, epochEnd)
+        return json.dumps([{"station": row[0], "mean": number(row[1]), "p50": number(row[2]),
+                            "p90": number(row[3]), "max": number(row[4]), "stops": number(row[5])}
+                           for row in rows])
+    return await cached(request, compute)
+
+
+async def trajectory(request):
+    departure, arrival = text(request, "from"), text(request, "to")
+    epoch = integer(request, "time")
+    G = request.app["graph"]
+
+    def compute():
+        trip = visualization.retrieveInDb(departure, arrival, epoch)
+        if len(trip) == 0:
+            return visualization.featureCollection([])
+        points = osm.retrieveTripCoordinates(trip[0][4], trip, G)
+        return visualization.featureCollection(visualization.tripFeatures(points, epoch))
+    return await cached(request, compute, "application/geo+json")
+
+
+async def live(request):
+    epochStart, epochEnd = integer(request, "start"), integer(request, "end")
+    G = request.app["graph"]
+
+    def compute():
+        return visualization.featureCollection(visualization.liveFeatures(G, epochStart, epochEnd))
+    return await cached(request, compute, "application/geo+json")
+
+
+async def hourIndex(request, epoch):
+    """
+    :return: the trainindex.TrainIndex of the hour of epoch, built once and shared by the
+    requests of this hour
+    """
+    app = request.app
+    hour = epoch - epoch % 3600
+
+    async def build():
+        return await asyncio.get_running_loop().run_in_executor(
+            app["executor"], trainindex.buildIndex, app["graph"], hour, hour + 3600)
+    return await app["indexes"].get(hour, build)
+
+
+def trainList(trips, lat, lon, distances=None):
+    result = [{"trip": int(trip), "lat": round(float(la), visualization.PRECISION),
+               "lon": round(float(lo), visualization.PRECISION)} for trip, la, lo in zip(trips, lat, lon)]
+    if distances is not None:
+        for train, distance in zip(result, distances):
+            train["distance"] = round(float(distance))
+    return result
+
+
+async def viewport(request):
+    epoch = integer(request, "time")
+    try:
+        minLon, minLat, maxLon, maxLat = (float(value) for value in text(request, "bbox").split(","))
+    except ValueError:
+        raise web.HTTPBadRequest(text="bbox must be <min lon>,<min lat>,<max lon>,<max lat>")
+    index = await hourIndex(request, epoch)
+    return web.json_response(trainList(*index.viewport(minLon, minLat, maxLon, maxLat, epoch)))
+
+
+async def nearest(request):
+    epoch, count = integer(request, "time"), integer(request, "k", 5)
+    try:
+        lat, lon = float(text(request, "lat")), float(text(request, "lon"))
+    except ValueError:
+        raise web.HTTPBadRequest(text="lat and lon must be numbers")
+    index = await hourIndex(request, epoch)
+    return web.json_response(trainList(*index.nearest(lat, lon, epoch, count)))
+
+
+async def metrics(request):
+    cache = request.app["cache"]
+    result = {"cacheHits": cache.hits, "cacheMisses": cache.misses, "cachedResponses": len(cache.entries)}
+    if isinstance(storage.getBackend(), storage.PostgresBackend):
+        import dbsession
+        result["pool"] = dbsession.poolMetrics()
+    return web.json_response(result)
+
+
+async def loadGraph(app):
+    """
+    Loads the railway graph, its snapping table, route cache and routing engine once, before
+    serving the first request
+    """
+    def load():
+        G = osm.loadGraph(app["graphPath"])
+        osm.loadSnapTable(G, app["graphPath"])
+        osm.loadRouteCache(G, app["graphPath"])
+        osm.loadEngine(G)
+        return G
+    app["graph"] = await asyncio.get_running_loop().run_in_executor(app["executor"], load)
+
+
+async def shutdown(app):
+    app["executor"].shutdown(wait=False)
+
+
+def createApp(graphPath=osm.GRAPH_PATH):
+    app = web.Application()
+    app["graphPath"] = graphPath
+    app["executor"] = ThreadPoolExecutor(max_workers=int(os.environ.get("TRAINDB_POOL_SIZE", "4")))
+    app["cache"] = ResponseCache()
+    app["indexes"] = ResponseCache(maxsize=INDEX_COUNT, ttl=CACHE_TTL * 10)
+    app["stations"] = loadStationIndex().displayNames()
+    app.on_startup.append(loadGraph)
+    app.on_cleanup.append(shutdown)
+    app.router.add_get("/stations", stationList)
+    app.router.add_get("/trips", trips)
+    app.router.add_get("/delays", delays)
+    app.router.add_get("/trajectory", trajectory)
+    app.router.add_get("/live", live)
+    app.router.add_get("/trains/viewport", viewport)
+    app.router.add_get("/trains/nearest", nearest)
+    app.router.add_get("/metrics", metrics)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(createApp(), port=int(sys.argv[1]) if len(sys.argv) > 1 else PORT)
@@ -0,0 +1,116 @@
+import csv
+import os
+import pickle
+from array import array
+from functools import lru_cache
+
+"""
+Index of the stations described in gtfs/stops.txt, shared by the ingestion, the dashboard and
+the OSM snapping. The file is parsed once per process, and the parsed columns are kept in a
+binary cache next to it, which is reused as long as stops.txt is not modified.
+IMPORTANT: please change STOPS_PATH to the location of your gtfs/stops.txt file
+"""
+
+STOPS_PATH = "data/gtfs/stops.txt"
+CACHE_SUFFIX = ".cache"
+
+
+class StationIndex:
+    """
+    Columns of the stations, indexed by their position: stopIds[i], names[i], latitudes[i] and
+    longitudes[i] describe the same station. Coordinates are stored as floats in arrays.
+    """
+
+    def __init__(self, stopIds, names, latitudes, longitudes):
+        self.stopIds = stopIds
+        self.names = names
+        self.latitudes = array('d', latitudes)
+        self.longitudes = array('d', longitudes)
+        self.positions = {stopId: i for i, stopId in enumerate(stopIds)}
+        self._positionsDict = None
+
+    def __len__(self):
+        return len(self.stopIds)
+
+    def station(self, stopId):
+        """
+        :return: the [name, latitude, longitude] list of a station
+        """
+        i = self.positions[stopId]
+        return [self.names[i], self.latitudes[i], self.longitudes[i]]
+
+    def positionsDict(self):
+        """
+        :return: the dictionary containing the stopID as the key and [name, latitude, longitude]
+        as values, built once
+        """
+        if self._positionsDict is None:
+            self._positionsDict = {stopId: self.station(stopId) for stopId in self.stopIds}
+        return self._positionsDict
+
+    def displayNames(self):
+        """
+        :return: the sorted list of the first word of each station name, as shown in the dashboard
+        """
+        return sorted({name.split(' ')[0] for name in self.names})
+
+
+def parseStops(path):
+    """
+    Reads stops.txt and keeps one entry per station: platform stops such as "8814001_5" are
+    merged into their station "8814001", and only numerical IDs are kept
+    :return: the StationIndex
+    """
+    stopIds, names, latitudes, longitudes = [], [], [], []
+    seen = set()
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            stopId = row['stop_id'].split('_')[0]
+            if stopId not in seen and stopId.isdigit():
+                seen.add(stopId)
+                stopIds.append(stopId)
+                names.append(row['stop_name'])
+                latitudes.append(float(row['stop_lat']))
+                longitudes.append(float(row['stop_lon']))
+    return StationIndex(stopIds, names, latitudes, longitudes)
+
+
+def readCache(cachePath, signature):
+    try:
+        with open(cachePath, 'rb') as f:
+            cached = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    if cached.get('signature') != signature:
+        return None
+    return StationIndex(cached['stopIds'], cached['names'], cached['latitudes'], cached['longitudes'])
+
+
+def writeCache(cachePath, signature, index):
+    # Written under a temporary name first, so concurrent import workers never read a partial file
+    tmpPath = "%s.%d" % (cachePath, os.getpid())
+    with open(tmpPath, 'wb') as f:
+        pickle.dump({'signature': signature, 'stopIds': index.stopIds, 'names': index.names,
+                     'latitudes': index.latitudes, 'longitudes': index.longitudes},
+                    f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpPath, cachePath)
+
+
+@lru_cache(maxsize=None)
+def loadStationIndex(path=STOPS_PATH):
+    """
+    Returns the station index of a stops.txt file, from the binary cache when it is still valid
+    :param path: location of the gtfs/stops.txt file
+    :return: the StationIndex, memoized for the whole process
+    """
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cachePath = path + CACHE_SUFFIX
+    index = readCache(cachePath, signature)
+    if index is None:
+        index = parseStops(path)
+        try:
+            writeCache(cachePath, signature, index)
+        except OSError:
+            pass
+    return index
@@ -0,0 +1,372 @@
+import csv
+import os
+import sqlite3
+import sys
+import threading
+from abc import ABC, abstractmethod
+
+import dbsession
+import delaystats
+import schema
+
+"""
+Storage backends of the station table. The dashboard goes through getBackend(), which returns
+the PostgreSQL backend by default, or the embedded SQLite backend when TRAINDB_BACKEND=sqlite.
+The SQLite backend needs no server: the database is a single file (TRAINDB_SQLITE_PATH) in WAL
+mode, with the same indexes as the PostgreSQL table.
+Usage: python storage.py load postgres|sqlite [workers]
+"""
+
+SQLITE_PATH = "traindb.sqlite"
+
+STATION_SELECT = "select id, nameStation, latStation, longStation, arrivalTime, trip, delay from station"
+# Columns of the stop-time history read by copyHistory
+HISTORY_COLUMNS = ("trip", "stopId", "nameStation", "arrivalTime", "delay")
+
+
+class StorageBackend(ABC):
+    """
+    Operations of the dashboard and the ingestion on the station table. Rows are returned in the
+    column order of STATION_SELECT.
+    """
+
+    @abstractmethod
+    def createTable(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def upsertTrips(self, trips):
+        """
+        Writes the trips decoded by db.extractTrips in one transaction, like db.upsertTrips: each
+        trip is identified by its (trip_id, service date) key, and a stop already stored for a
+        trip is updated instead of being inserted again. The delay statistics are refreshed too
+        when the backend keeps them.
+        :return: the number of written rows
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrievePath(self, trip):
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieveArrivalStation(self, station, epoch):
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieveDepartureStation(self, station, epoch):
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieveMean(self, trip, epochStart, epochEnd):
+        raise NotImplementedError
+
+    @abstractmethod
+    def findTrips(self, departureStation, arrivalStation, epoch, limit=5):
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieveDelayStats(self, trip, epochStart, epochEnd):
+        raise NotImplementedError
+
+    @abstractmethod
+    def copyHistory(self, out, epochStart=None, epochEnd=None):
+        """
+        Writes the stops between two times as CSV with a header, in one bulk read
+        :param out: text file object receiving the rows of HISTORY_COLUMNS, ordered by trip and time
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def activeTrips(self, epochStart, epochEnd):
+        """
+        :return: every trip running between two times, each one being the list of its rows
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PostgresBackend(StorageBackend):
+    """
+    The station table of PostgreSQL: reads go through the connection pool of dbsession, writes
+    through a dedicated connection
+    """
+
+    def __init__(self):
+        import db
+        self.db = db
+        self.conn = None
+
+    def writer(self):
+        if self.conn is None:
+            self.conn, cur = self.db.connectToDB()
+            cur.close()
+        return self.conn
+
+    def createTable(self):
+        cur = self.writer().cursor()
+        self.db.createTable(cur)
+        schema.createIngestionTables(cur)
+        self.conn.commit()
+        cur.close()
+
+    def upsertTrips(self, trips):
+        cur = self.writer().cursor()
+        try:
+            schema.createStagingTable(cur)
+            tripIds, written, stale = self.db.upsertTrips(cur, trips)
+            delaystats.refreshDelayStats(cur, tripIds, stale)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        return written
+
+    def retrievePath(self, trip):
+        return self.db.retrievePath(trip)
+
+    def retrieveArrivalStation(self, station, epoch):
+        return self.db.retrieveArrivalStation(station, epoch)
+
+    def retrieveDepartureStation(self, station, epoch):
+        return self.db.retrieveDepartureStation(station, epoch)
+
+    def retrieveMean(self, trip, epochStart, epochEnd):
+        return self.db.retrieveMean(trip, epochStart, epochEnd)
+
+    def findTrips(self, departureStation, arrivalStation, epoch, limit=5):
+        return self.db.findTrips(departureStation, arrivalStation, epoch, limit)
+
+    def retrieveDelayStats(self, trip, epochStart, epochEnd):
+        return self.db.retrieveDelayStats(trip, epochStart, epochEnd)
+
+    def copyHistory(self, out, epochStart=None, epochEnd=None):
+        with dbsession.session() as conn:
+            cur = conn.cursor()
+            cur.copy_expert("COPY (%s) TO STDOUT WITH CSV HEADER" % historySelect(epochStart, epochEnd), out)
+            cur.close()
+
+    def activeTrips(self, epochStart, epochEnd):
+        return self.db.retrieveActiveTrips(epochStart, epochEnd)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Embedded station table. Each thread gets its own connection, so that readers of the
+    dashboard and service threads do not wait for each other in WAL mode.
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def query(self, sql, params):
+        return self.connection().execute(sql, params).fetchall()
+
+    def createTable(self):
+        conn = self.connection()
+        conn.execute("DROP TABLE IF EXISTS station")
+        conn.execute("DROP TABLE IF EXISTS trip_key")
+        conn.execute('''CREATE TABLE station
+                   (id INTEGER PRIMARY KEY,
+                    nameStation TEXT,
+                    latStation REAL,
+                    longStation REAL,
+                    arrivalTime INTEGER,
+                    trip INTEGER,
+                    delay INTEGER,
+                    stopId INTEGER);''')
+        conn.execute('''CREATE TABLE trip_key
+                   (id INTEGER PRIMARY KEY,
+                    tripId TEXT,
+                    serviceDate TEXT,
+                    UNIQUE (tripId, serviceDate));''')
+        for name, target in schema.INDEXES.items():
+            conn.execute("CREATE INDEX IF NOT EXISTS %s ON %s" % (name, target))
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS station_trip_stop_key ON station (trip, stopId)")
+        conn.commit()
+
+    def upsertTrips(self, trips):
+        import db
+        conn = self.connection()
+        insert = ("INSERT INTO station (%s) VALUES (%s) ON CONFLICT (trip, stopId) DO UPDATE SET "
+                  "arrivalTime = excluded.arrivalTime, delay = excluded.delay"
+                  % (", ".join(db.STATION_COLUMNS), ", ".join("?" * len(db.STATION_COLUMNS))))
+        written = 0
+        with conn:
+            for tripKey, trip in trips:
+                conn.execute("INSERT OR IGNORE INTO trip_key (tripId, serviceDate) VALUES (?, ?)", tripKey)
+                tripId = conn.execute("SELECT id FROM trip_key WHERE tripId = ? AND serviceDate = ?",
+                                      tripKey).fetchone()[0]
+                # Stops in time order, the latest update of a stop listed twice wins
+                conn.executemany(insert, [(name, lat, lon, epoch, tripId, delay, stopId)
+                                          for name, lat, lon, epoch, delay, stopId in trip])
+                written += len(trip)
+        return written
+
+    def retrievePath(self, trip):
+        return self.query(STATION_SELECT + " where trip = ? order by arrivalTime", (trip,))
+
+    def retrieveArrivalStation(self, station, epoch):
+        return self.query(STATION_SELECT + " where nameStation = ? and arrivalTime > ?", (station, epoch))
+
+    def retrieveDepartureStation(self, station, epoch):
+        return self.query(STATION_SELECT + " where nameStation = ? and arrivalTime < ?", (station, epoch))
+
+    def retrieveMean(self, trip, epochStart, epochEnd):
+        return self.query("select nameStation, CAST(ROUND(AVG(delay) / 60.0) AS INTEGER) from station "
+                          "where trip = ? and arrivalTime > ? and arrivalTime < ? "
+                          "GROUP BY nameStation ORDER BY AVG(arrivalTime)", (trip, epochStart, epochEnd))
+
+    def findTrips(self, departureStation, arrivalStation, epoch, limit=5):
+        rows = self.query("WITH matches AS (SELECT d.trip, d.arrivalTime AS departureTime FROM station d "
+                          "WHERE d.nameStation = ? AND d.arrivalTime >= ? AND EXISTS (SELECT 1 FROM station a "
+                          "WHERE a.trip = d.trip AND a.nameStation = ? AND a.arrivalTime > d.arrivalTime) "
+                          "ORDER BY d.arrivalTime LIMIT ?) "
+                          "select s.id, s.nameStation, s.latStation, s.longStation, s.arrivalTime, s.trip, s.delay "
+                          "from matches m JOIN station s ON s.trip = m.trip "
+                          "ORDER BY m.departureTime, s.trip, s.arrivalTime",
+                          (departureStation, epoch, arrivalStation, limit))
+        return groupTrips(rows)
+
+    def retrieveDelayStats(self, trip, epochStart, epochEnd):
+        """
+        Computed from the stops of the trip itself: SQLite has no percentile aggregate, so the
+        statistics are not precomputed per trip pattern as in PostgreSQL
+        """
+        rows = self.query("select nameStation, delay, arrivalTime from station "
+                          "where trip = ? and arrivalTime > ? and arrivalTime < ?", (trip, epochStart, epochEnd))
+        delays = {}
+        times = {}
+        for name, delay, epoch in rows:
+            delays.setdefault(name, []).append(delay)
+            times.setdefault(name, []).append(epoch)
+        result = []
+        for name in sorted(delays, key=lambda name: sum(times[name]) / len(times[name])):
+            values = sorted(delays[name])
+            result.append((name, round(sum(values) / len(values) / 60), round(percentile(values, 0.5) / 60),
+                           round(percentile(values, 0.9) / 60), round(values[-1] / 60), len(values)))
+        return result
+
+    def copyHistory(self, out, epochStart=None, epochEnd=None):
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(HISTORY_COLUMNS)
+        writer.writerows(self.connection().execute(historySelect(epochStart, epochEnd)))
+
+    def activeTrips(self, epochStart, epochEnd):
+        rows = self.query("WITH active AS (SELECT trip FROM station "
+                          "WHERE arrivalTime >= ? AND arrivalTime < ? "
+                          "GROUP BY trip HAVING MIN(arrivalTime) < ? AND MAX(arrivalTime) > ?) "
+                          "select s.id, s.nameStation, s.latStation, s.longStation, s.arrivalTime, s.trip, s.delay "
+                          "from active JOIN station s ON s.trip = active.trip "
+                          "ORDER BY s.trip, s.arrivalTime",
+                          (epochStart - dbsession.MAX_STOP_GAP, epochEnd + dbsession.MAX_STOP_GAP, epochEnd, epochStart))
+        return groupTrips(rows)
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+def historySelect(epochStart=None, epochEnd=None):
+    """
+    :return: the query of the stops between two times, ordered by trip and time. The times are
+    written in the query, since COPY takes no parameters.
+    """
+    sql = "SELECT %s FROM station" % ", ".join(HISTORY_COLUMNS)
+    conditions = []
+    if epochStart is not None:
+        conditions.append("arrivalTime >= %d" % int(epochStart))
+    if epochEnd is not None:
+        conditions.append("arrivalTime < %d" % int(epochEnd))
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    return sql + " ORDER BY trip, arrivalTime"
+
+
+def groupTrips(rows):
+    """
+    Splits rows ordered by trip into one list per trip
+    """
+    trips = []
+    for row in rows:
+        if not trips or trips[-1][0][5] != row[5]:
+            trips.append([])
+        trips[-1].append(row)
+    return trips
+
+
+def percentile(values, fraction):
+    """
+    Continuous percentile of sorted values, like percentile_cont of PostgreSQL
+    """
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+_backend = None
+_lock = threading.Lock()
+
+
+def getBackend():
+    """
+    :return: the backend selected by TRAINDB_BACKEND, created once per process
+    """
+    global _backend
+    with _lock:
+        if _backend is None:
+            _backend = createBackend(os.environ.get("TRAINDB_BACKEND", "postgres"))
+        return _backend
+
+
+def createBackend(name):
+    if name == "postgres":
+        return PostgresBackend()
+    if name == "sqlite":
+        return SqliteBackend(os.environ.get("TRAINDB_SQLITE_PATH", SQLITE_PATH))
+    raise ValueError("unknown storage backend: %s" % name)
+
+
+def loadInto(backend, files=None, workers=1):
+    """
+    Rebuilds the station table of a backend from the gtfsrt files of the data folder, one
+    transaction per file, with the trips identified by their (trip_id, service date) like the
+    incremental db.importGtfsData
+    :return: the number of written rows and the elapsed time in seconds
+    """
+    import db
+
+    dataPath = "data/"
+    if files is None:
+        files = db.listGtfsFiles(dataPath)
+    backend.createTable()
+    return db.ingestFiles(files, lambda file, trips: backend.upsertTrips(trips), workers, dataPath)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "load":
+        print("usage: python storage.py load postgres|sqlite [workers]")
+        sys.exit(1)
+    loadInto(createBackend(sys.argv[2]), workers=int(sys.argv[3]) if len(sys.argv) > 3 else 1)
@@ -0,0 +1,27 @@
+import pandas as pd
+
+import analytics
+
+"""
+Statistics of analytics on small stop-time histories
+"""
+
+
+def history(rows):
+    return pd.DataFrame(rows, columns=analytics.COLUMNS).astype(analytics.DTYPES)
+
+
+def testSummaryOfNoStops():
+    results = analytics.summary(history([]))
+    assert all(len(table) == 0 for name, table in results.items() if name != "distribution")
+    assert results["distribution"]["stops"].sum() == 0
+    assert list(results["stationHour"].columns) == ["nameStation", "hour", "stops", "mean", "p50", "p90", "max"]
+
+
+def testDelayPropagation():
+    frame = history([(1, 1, "A", 1000, 60), (1, 2, "B", 1600, 120), (1, 3, "C", 2200, 90),
+                     (2, 1, "A", 1100, 0), (2, 2, "B", 1700, 60)])
+    sections = analytics.delayPropagation(frame).set_index(["fromStation", "toStation"])
+    assert sections.loc[("A", "B"), "runs"] == 2
+    assert sections.loc[("A", "B"), "meanGained"] == 60
+    assert sections.loc[("B", "C"), "meanGained"] == -30
@@ -0,0 +1,36 @@
+import numpy as np
+
+import graphcache
+import osm
+import routing
+
+"""
+Shortest paths of routing.RoutingEngine and timestamps of osm.interpolateRoutes
+"""
+
+
+def railGraph():
+    # 10 -> 20 -> 30 is shorter than the direct edge 10 -> 30, 40 cannot be reached
+    return graphcache.RailGraph(np.array([10, 20, 30, 40]), np.array([4.0, 4.1, 4.2, 4.3]),
+                                np.array([50.0, 50.1, 50.2, 50.3]), np.array([0, 0, 1, 0]),
+                                np.array([1, 1, 2, 2]), np.array([2.0, 1.0, 1.0, 5.0]), "epsg:4326")
+
+
+def testPaths():
+    engine = routing.RoutingEngine(railGraph())
+    paths = engine.paths([(10, 30), (10, 40), (30, 10), (20, 20)])
+    assert [path.tolist() for path in paths] == [[0, 1, 2], [], [], [1]]
+
+
+def testRoutes():
+    route = routing.RoutingEngine(railGraph()).routes([(10, 20)])[0]
+    assert route.tolist() == [[50.0, 4.0], [50.1, 4.1]]
+
+
+def testInterpolateRoutes():
+    coords = np.array([[50.0, 4.0], [50.0, 4.1], [50.0, 4.3], [51.0, 5.0], [51.0, 5.0]])
+    times = osm.interpolateRoutes(coords, np.array([3, 2]), np.array([0.0, 1000.0]), np.array([300.0, 1100.0]))
+    assert times[0] == 0 and times[2] == 300
+    assert np.isclose(times[1], 100, atol=1)
+    # A route without length is spread evenly over its time
+    assert times[3:].tolist() == [1050.0, 1100.0]
@@ -0,0 +1,77 @@
+import io
+
+import pytest
+
+import analytics
+import db
+import storage
+
+"""
+SQLite backend of the station table, filled by storage.loadInto from decoded snapshots
+"""
+
+
+def stop(name, epoch, delay, stopId):
+    return name, 50.0 + stopId / 100, 4.0 + stopId / 100, epoch, delay, stopId
+
+
+# Decoded trips of each gtfsrt file, see db.extractTrips
+SNAPSHOTS = {
+    "1.gtfsrt": [(("IC1", "20240101"), [stop("A", 1000, 0, 1), stop("B", 1600, 60, 2), stop("C", 2200, 120, 3)]),
+                 (("IC2", "20240101"), [stop("C", 1200, 0, 3), stop("B", 1800, 0, 2), stop("A", 2400, 0, 1)])],
+    # Later snapshot: IC1 is late at its remaining stops, and runs again the next day
+    "2.gtfsrt": [(("IC1", "20240101"), [stop("B", 1660, 120, 2), stop("C", 2300, 180, 3)]),
+                 (("IC1", "20240102"), [stop("A", 87400, 0, 1), stop("B", 88000, 0, 2)])],
+}
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "decodeGtfsFile", lambda url: SNAPSHOTS[url.rsplit("/", 1)[-1]])
+    backend = storage.SqliteBackend(str(tmp_path / "traindb.sqlite"))
+    storage.loadInto(backend, sorted(SNAPSHOTS))
+    yield backend
+    backend.close()
+
+
+def tripId(backend, departure, arrival, epoch=0):
+    return backend.findTrips(departure, arrival, epoch, limit=1)[0][0][5]
+
+
+def testSnapshotsUpdateTheStopsOfATrip(backend):
+    path = backend.retrievePath(tripId(backend, "A", "C"))
+    assert [(row[1], row[4], row[6]) for row in path] == [("A", 1000, 0), ("B", 1660, 120), ("C", 2300, 180)]
+    assert backend.query("select count(*) from station", ())[0][0] == 8
+
+
+def testFindTrips(backend):
+    forward = backend.findTrips("A", "C", 0)
+    assert [[row[1] for row in trip] for trip in forward] == [["A", "B", "C"]]
+    assert [[row[1] for row in trip] for trip in backend.findTrips("C", "A", 0)] == [["C", "B", "A"]]
+    assert backend.findTrips("A", "C", 1001) == []
+    # Both days of IC1 go from A to B, in order of departure
+    assert [trip[0][4] for trip in backend.findTrips("A", "B", 0)] == [1000, 87400]
+    assert len(backend.findTrips("A", "B", 0, limit=1)) == 1
+
+
+def testActiveTrips(backend):
+    trips = backend.activeTrips(1500, 1700)
+    assert sorted(trip[0][1] for trip in trips) == ["A", "C"]
+    assert all(len(trip) == 3 for trip in trips)
+    assert backend.activeTrips(3000, 4000) == []
+
+
+def testRetrieveDelayStats(backend):
+    stats = backend.retrieveDelayStats(tripId(backend, "A", "C"), 0, 3600)
+    assert [(row[0], row[1], row[4], row[5]) for row in stats] == [("A", 0, 0, 1), ("B", 2, 2, 1), ("C", 3, 3, 1)]
+
+
+def testCopyHistory(backend, monkeypatch):
+    out = io.StringIO()
+    backend.copyHistory(out, 1000, 2300)
+    lines = out.getvalue().splitlines()
+    assert lines[0] == ",".join(storage.HISTORY_COLUMNS)
+    assert [line.split(",")[2:4] for line in lines[1:]] == [["A", "1000"], ["B", "1660"], ["C", "1200"], ["B", "1800"]]
+    monkeypatch.setattr(storage, "getBackend", lambda: backend)
+    frame = analytics.loadHistory(1000, 2300)
+    assert len(frame) == 4 and frame["delay"].tolist() == [0, 120, 0, 0]
@@ -0,0 +1,31 @@
+import numpy as np
+
+import osm
+import trainindex
+
+"""
+Viewport and nearest queries of trainindex.TrainIndex on two straight trajectories
+"""
+
+
+def trajectory(lat, lon, start):
+    return np.array([(lat, lon, start), (lat, lon + 0.1, start + 100)], dtype=osm.TRAJECTORY_DTYPE)
+
+
+def trainIndex():
+    # Only the trip ID of the first row of each trip is read
+    trips = [[(0, "A", lat, lon, 0, trip, 0)] for trip, lat, lon in ((7, 50.0, 4.0), (8, 51.0, 5.0))]
+    return trainindex.TrainIndex(trips, [trajectory(50.0, 4.0, 0), trajectory(51.0, 5.0, 0)], bucket=30)
+
+
+def testViewport():
+    trips, lat, lon = trainIndex().viewport(3.9, 49.9, 4.2, 50.1, 50)
+    assert trips.tolist() == [7]
+    assert np.isclose(lon[0], 4.05) and np.isclose(lat[0], 50.0)
+    assert len(trainIndex().viewport(3.9, 49.9, 4.2, 50.1, 150)[0]) == 0
+
+
+def testNearest():
+    trips, lat, lon, distances = trainIndex().nearest(51.0, 5.05, 50, count=2)
+    assert trips.tolist() == [8, 7]
+    assert distances[0] < 1 and distances[1] > 100000
@@ -0,0 +1,150 @@
+import numpy as np
+import shapely
+from shapely import STRtree
+
+import osm
+import storage
+
+"""
+Spatio-temporal index of the trains, answering "which trains are in this map viewport at time T"
+and "which trains are nearest to this point at time T" without walking every trajectory.
+The trajectories are cut into segments between consecutive route nodes, each one covering a
+bounding box during a time interval. The segments are grouped by time bucket, and the boxes of
+each bucket are indexed by an STRtree: a query reads one tree, then interpolates the position of
+the few candidate trains at the asked time.
+"""
+
+# Duration of a time bucket in seconds
+BUCKET = 300
+# Half width in degrees of the first box searched by nearest, doubled until enough trains are found
+NEAREST_RADIUS = 0.05
+METERS_PER_DEGREE = osm.EARTH_RADIUS * np.pi / 180
+
+
+class TrainIndex:
+    def __init__(self, trips, trajectories, bucket=BUCKET):
+        """
+        :param trips: rows of the station table of each trip
+        :param trajectories: structured arrays returned by osm.retrieveTrajectories
+        :param bucket: duration of a time bucket in seconds
+        """
+        self.bucket = bucket
+        self.trips = np.array([trip[0][5] for trip in trips], dtype=np.int64)
+        segments = [(np.full(len(trajectory) - 1, i, dtype=np.int64), trajectory[:-1], trajectory[1:])
+                    for i, trajectory in enumerate(trajectories) if len(trajectory) > 1]
+        if segments:
+            self.train = np.concatenate([train for train, _, _ in segments])
+            starts = np.concatenate([start for _, start, _ in segments])
+            ends = np.concatenate([end for _, _, end in segments])
+        else:
+            self.train = np.empty(0, dtype=np.int64)
+            starts = ends = np.empty(0, dtype=osm.TRAJECTORY_DTYPE)
+        self.lat0, self.lon0, self.t0 = starts['lat'], starts['lon'], starts['t']
+        self.lat1, self.lon1, self.t1 = ends['lat'], ends['lon'], ends['t']
+        boxes = shapely.box(np.minimum(self.lon0, self.lon1), np.minimum(self.lat0, self.lat1),
+                            np.maximum(self.lon0, self.lon1), np.maximum(self.lat0, self.lat1))
+
+        # A segment belongs to every bucket its time interval overlaps
+        first = np.floor_divide(self.t0, bucket).astype(np.int64)
+        last = np.floor_divide(self.t1, bucket).astype(np.int64)
+        counts = np.maximum(last - first + 1, 1)
+        segment = np.repeat(np.arange(len(first)), counts)
+        buckets = first[segment] + np.arange(len(segment)) - np.repeat(np.cumsum(counts) - counts, counts)
+        order = np.argsort(buckets, kind="stable")
+        segment, buckets = segment[order], buckets[order]
+        self.segments = {}
+        self.trees = {}
+        for key, begin, end in zip(*bucketRanges(buckets)):
+            self.segments[key] = segment[begin:end]
+            self.trees[key] = STRtree(boxes[segment[begin:end]])
+        if len(boxes):
+            self.bounds = shapely.total_bounds(boxes)
+        else:
+            self.bounds = np.zeros(4)
+
+    def __len__(self):
+        return len(self.trips)
+
+    def candidates(self, geometry, epoch):
+        """
+        :return: the segments of the bucket of epoch whose box intersects the geometry, and that
+        are travelled at epoch
+        """
+        key = int(epoch // self.bucket)
+        if key not in self.trees:
+            return np.empty(0, dtype=np.int64)
+        found = self.segments[key][self.trees[key].query(geometry)]
+        return found[(self.t0[found] <= epoch) & (epoch <= self.t1[found])]
+
+    def positions(self, found, epoch):
+        """
+        Interpolates the position of the trains at epoch on their segments, one per train
+        :return: arrays of the trip IDs, latitudes and longitudes
+        """
+        duration = self.t1[found] - self.t0[found]
+        fraction = np.where(duration > 0, (epoch - self.t0[found]) / np.where(duration > 0, duration, 1), 0)
+        lat = self.lat0[found] + (self.lat1[found] - self.lat0[found]) * fraction
+        lon = self.lon0[found] + (self.lon1[found] - self.lon0[found]) * fraction
+        # A train on the node between two segments is found twice
+        trains, first = np.unique(self.train[found], return_index=True)
+        return self.trips[trains], lat[first], lon[first]
+
+    def viewport(self, minLon, minLat, maxLon, maxLat, epoch):
+        """
+        :return: arrays of the trip IDs, latitudes and longitudes of the trains inside the box at epoch
+        """
+        trips, lat, lon = self.positions(self.candidates(shapely.box(minLon, minLat, maxLon, maxLat), epoch), epoch)
+        inside = (minLat <= lat) & (lat <= maxLat) & (minLon <= lon) & (lon <= maxLon)
+        return trips[inside], lat[inside], lon[inside]
+
+    def nearest(self, lat, lon, epoch, count=5):
+        """
+        Searches boxes of growing size around the point until they contain count trains closer
+        than the half width of the box
+        :return: arrays of the trip IDs, latitudes, longitudes and distances in meters of the
+        nearest trains at epoch, ordered by distance
+        """
+        radius = NEAREST_RADIUS
+        extent = max(abs(lon - self.bounds[0]), abs(lon - self.bounds[2]),
+                     abs(lat - self.bounds[1]), abs(lat - self.bounds[3]))
+        while True:
+            found = self.candidates(shapely.box(lon - radius, lat - radius, lon + radius, lat + radius), epoch)
+            trips, trainLat, trainLon = self.positions(found, epoch)
+            distances = haversine(lat, lon, trainLat, trainLon)
+            # Every train closer than this distance lies inside the box
+            covered = radius * METERS_PER_DEGREE * np.cos(np.radians(min(abs(lat) + radius, 90)))
+            if np.count_nonzero(distances <= covered) >= count or radius > extent:
+                break
+            radius *= 2
+        order = np.argsort(distances)[:count]
+        return trips[order], trainLat[order], trainLon[order], distances[order]
+
+
+def bucketRanges(buckets):
+    """
+    :param buckets: sorted array of bucket numbers
+    :return: the distinct buckets, and the first and last + 1 position of each one
+    """
+    if len(buckets) == 0:
+        return [], [], []
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    ends = np.append(starts[1:], len(buckets))
+    return buckets[starts].tolist(), starts.tolist(), ends.tolist()
+
+
+def haversine(lat, lon, lats, lons):
+    """
+    :return: the distances in meters between a point and arrays of points
+    """
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * osm.EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def buildIndex(osmdata, epochStart, epochEnd, bucket=BUCKET):
+    """
+    Indexes every train running between two times, see visualization.liveFeatures
+    :return: the TrainIndex
+    """
+    trips = storage.getBackend().activeTrips(epochStart, epochEnd)
+    return TrainIndex(trips, osm.retrieveTrajectories(trips, osmdata), bucket)
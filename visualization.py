@@ -1,43 +1,38 @@
+import hashlib
 import json
 import os
+import threading
 import webbrowser
 from datetime import datetime
+from functools import lru_cache
 
-import psycopg2
+import numpy as np
 from folium.plugins import TimestampedGeoJson
 # gtfs-realtime-bindings
 import folium
 import osm
-from db import retrieveDepartureStation, retrieveArrivalStation, retrieveStations, retrievePath, retrieveMean
+import storage
 import osmnx as ox
 
-def retrieveCoordinates(currentMoment):
+# Rendered maps: the trajectories of each request are written to their own script, shown by a
+# page built from the base map
+MAP_DIR = "maps/"
+DATA_PLACEHOLDER = "__TRAIN_DATA__"
+# Pages kept in MAP_DIR with their scripts, the least recently used ones are deleted
+MAX_MAPS = 200
+# Decimals of the coordinates, about one meter
+PRECISION = 5
+
+
+def relevantPoints(trajectory, currentMoment):
     """
-    Function that allows retrieving coordinates from the travels.txt file and add it into a
-    coordinate object, used to create a json object
-    :return: the coordinate object
+    A point is kept when the train has not yet reached the next one, the last point is always kept
+    :param trajectory: structured array returned by osm.retrieveTripCoordinates
+    :return: the records of the trajectory the train has not passed yet at a given moment
     """
-    coordinates = []
-    index = 0
-    with open('travels.txt', 'r') as travels:
-        for i, line in enumerate(travels):
-            longitude = float(line.split(',')[1])
-            latitude = float(line.split(',')[0])
-            epochTime = float(line.split(',')[2])
-            try:
-                nextEpochTime = float(next(travels).split(',')[2])
-            except StopIteration:
-                break
-            nextLine = travels.readline()
-            if nextLine != '':
-                if nextEpochTime > currentMoment:
-                    coordinates.append({"coordinates": [latitude, longitude],
-                                        "time": datetime.fromtimestamp(float(epochTime)).isoformat() + "Z"})
-                index += 1
-            else:
-                coordinates.append({"coordinates": [latitude, longitude],
-                                    "time": datetime.fromtimestamp(float(epochTime)).isoformat() + "Z"})
-        return coordinates
+    keep = np.ones(len(trajectory), dtype=bool)
+    keep[:-1] = trajectory['t'][1:] > currentMoment
+    return trajectory[keep]
 
 
 def testGeoJson():
@@ -57,127 +52,252 @@ def testGeoJson():
     return [feature_collection]
 
 
-def truncateCoordinates(currentMoment, coordinates):
-    # 1679955725
-    #print(coordinates)
-    #print(currentMoment)
-    pass
+def localOffset(epoch):
+    """
+    The maps show the local time as if it was UTC
+    :return: the offset in seconds to add to the times of the features
+    """
+    return datetime.fromtimestamp(epoch).astimezone().utcoffset().total_seconds()
 
 
-def createGeoJSON(currentMoment):
+def compactFeature(points, offset, popup=None):
     """
-    Function that creates a geoJSON object. We pass it coordinates so the pin on the map can move
-    according to a determined time
-    :return:
+    Creates a moving LineString feature with its coordinates rounded to PRECISION decimals and
+    its times in milliseconds
+    :param points: records of osm.TRAJECTORY_DTYPE
     """
-    coordinates = retrieveCoordinates(currentMoment)
-    truncateCoordinates(currentMoment, coordinates)
+    feature = {
+        "type": "Feature",
+        "geometry": {
+            "type": "LineString",
+            "coordinates": np.round(np.column_stack((points['lon'], points['lat'])), PRECISION).tolist()
+        },
+        "properties": {
+            "times": ((points['t'] + offset) * 1000).astype(np.int64).tolist()
+        }
+    }
+    if popup:
+        feature["properties"]["popup"] = popup
+    return feature
 
-    # for coordinates in coordinatesSet:
-    #    coordinates[0]['coordinates'] = coordinates[1]['coordinates']
-    geoJSONSet = []
 
-    feature_collection = {
-        "type": "FeatureCollection",
-        "features": [{
-            "type": "Feature",
-            "geometry": {
-                "type": "LineString",
-                "coordinates": [coord["coordinates"] for coord in coordinates]
-            },
-            "properties": {
-                "times": [coord["time"] for coord in coordinates]
+@lru_cache(maxsize=None)
+def baseMap():
+    """
+    Builds, once per process, the page of the map with the animation plugin and its assets. It
+    defines loadTrains(featureCollection), which replaces the trains shown on the map.
+    :return: the html of the page, with DATA_PLACEHOLDER in place of the script of the trajectories
+    """
+    belgium_coords = [50.64, 4.67]
+    m = folium.Map(location=belgium_coords, zoom_start=8)
+    empty = TimestampedGeoJson({"type": "FeatureCollection", "features": []}, period="PT1S",
+                               add_last_point=True, auto_play=True, loop=True)
+    empty.add_to(m)
+    m.get_root().script.add_child(folium.Element('''
+        var trainLayer = null;
+        function loadTrains(data) {
+            // The empty layer of the plugin is created after this script, it is looked up here
+            if (trainLayer === null && typeof %(layer)s !== 'undefined') {
+                trainLayer = %(layer)s;
             }
-        }]
-    }
-    geoJSONSet.append(feature_collection.copy())
-    return geoJSONSet
+            if (trainLayer) {
+                %(map)s.removeLayer(trainLayer);
+            }
+            var features = L.geoJson(data, {
+                onEachFeature: function (feature, layer) {
+                    if (feature.properties.popup) {
+                        layer.bindPopup(feature.properties.popup);
+                    }
+                }
+            });
+            trainLayer = L.timeDimension.layer.geoJson(features, {
+                updateTimeDimension: true,
+                updateTimeDimensionMode: 'replace',
+                addlastPoint: true
+            }).addTo(%(map)s);
+            if (features.getLayers().length > 0) {
+                %(map)s.fitBounds(features.getBounds());
+            }
+        }
+    ''' % {"layer": empty.get_name(), "map": m.get_name()}))
+    return m.get_root().render() + '\n<script src="%s"></script>\n' % DATA_PLACEHOLDER
 
 
-def visualizeTrains(currentMoment):
+@lru_cache(maxsize=None)
+def basePage():
     """
-    Function that allows visualizing moving trains on a map. First we create a map and center it
-    on a set of coordinates. Then, we create a geoJSOn object, define its parameters, save it into
-    and html file and open the html
-    :return:
+    Writes the base map without trajectories, for the map embedded in the dashboard, which
+    receives them through loadTrains
+    :return: the absolute path of the page
     """
-    belgium_coords = [51.17147, 4.142963]
-    m = folium.Map(location=belgium_coords, zoom_start=10)
+    os.makedirs(MAP_DIR, exist_ok=True)
+    path = os.path.abspath(MAP_DIR + "base.html")
+    page = baseMap().replace('<script src="%s"></script>' % DATA_PLACEHOLDER, '')
+    writeAtomically(path, lambda f: f.write(page))
+    return path
 
-    feature_collection = createGeoJSON(currentMoment)
 
-    # Add the GeoJSON data to the map
+def featureCollection(features):
+    """
+    :return: the compact JSON text of a feature collection, as given to loadTrains
+    """
+    return ('{"type":"FeatureCollection","features":['
+            + ",".join(json.dumps(feature, separators=(',', ':')) for feature in features) + ']}')
 
-    # create TimestampedGeoJson object for the current feature collection
-    geojson = TimestampedGeoJson(
-        json.dumps(feature_collection),
-        period="PT1S",  # update frequency in seconds
-        add_last_point=True,  # add a marker at the last point of the trajectory
-        auto_play=True,  # autoplay the animation
-        loop=True,  # loop the animation
-    )
 
-    # add the TimestampedGeoJson object to the map
+def writeAtomically(path, write):
+    # Under a temporary name first, so a page never loads a partial file
+    tmpPath = "%s.%d.%d" % (path, os.getpid(), threading.get_ident())
+    with open(tmpPath, 'w', encoding='utf-8') as f:
+        write(f)
+    os.replace(tmpPath, path)
 
-    geojson.add_to(m)
 
-    # Show the map in PyCharm
-    m.save("map.html")
-    travelPath = 'travels.txt'
-    if os.path.exists(travelPath):
-        os.remove(travelPath)
-    return "map.html"
-    #webbrowser.open('map.html')
+def writeMap(features):
+    """
+    Streams the features, one at a time, to their own script, and writes the page showing them
+    on the base map. Both are named after the content, so that different requests never
+    overwrite each other and the same request reuses its files.
+    :return: the path of the page
+    """
+    os.makedirs(MAP_DIR, exist_ok=True)
+    digest = hashlib.sha1()
+    tmpPath = MAP_DIR + "features.%d.%d" % (os.getpid(), threading.get_ident())
+    with open(tmpPath, 'w', encoding='utf-8') as f:
+        f.write('loadTrains({"type":"FeatureCollection","features":[')
+        for i, feature in enumerate(features):
+            chunk = ("," if i else "") + json.dumps(feature, separators=(',', ':'))
+            digest.update(chunk.encode('utf-8'))
+            f.write(chunk)
+        f.write(']});\n')
+    name = digest.hexdigest()[:16]
+    os.replace(tmpPath, MAP_DIR + name + ".js")
+    pagePath = MAP_DIR + name + ".html"
+    if os.path.exists(pagePath):
+        os.utime(pagePath)
+    else:
+        writeAtomically(pagePath, lambda f: f.write(baseMap().replace(DATA_PLACEHOLDER, name + ".js")))
+    pruneMaps(keep=name)
+    return pagePath
 
 
-def retrieveInDb(station1, station2, epoch):
-    conn = psycopg2.connect(database="traindb", user="postgres", password="password", host="localhost", port="5432")
-    departureStation = retrieveDepartureStation(conn, station1, epoch)
-    arrivalStation = retrieveArrivalStation(conn, station2, epoch)
+def pruneMaps(maxMaps=MAX_MAPS, keep=None):
+    """
+    Deletes the least recently written pages of writeMap and their scripts, so that MAP_DIR
+    holds at most maxMaps of them. The base page is left alone.
+    :param keep: name of a page never deleted, the one just written
+    """
+    pages = []
+    for entry in os.scandir(MAP_DIR):
+        name, extension = os.path.splitext(entry.name)
+        if extension == ".html" and name not in ("base", keep):
+            try:
+                pages.append((entry.stat().st_mtime, name))
+            except OSError:
+                pass
+    pages.sort()
+    # The kept page is one of the maxMaps
+    excess = len(pages) - (maxMaps - 1 if keep else maxMaps)
+    for _, name in pages[:max(excess, 0)]:
+        for path in (MAP_DIR + name + ".html", MAP_DIR + name + ".js"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-    # on peut simplifier, je laisse comme ça pour le débeug
-    validArrivalStation, validDepartureStation = retrieveStations(arrivalStation, departureStation)
-    if len(validArrivalStation) == 0 or len(validDepartureStation) == 0:
-        return []
-    if validDepartureStation[0][0][-1] == validArrivalStation[0][-1]:#-1
-        tripId = validArrivalStation[0][-2] #-1
-        trip = retrievePath(conn, tripId)
-        conn.close()
-        return trip
+
+def visualizeTrains(trajectory, currentMoment):
+    """
+    Function that allows visualizing a moving train on a map: the part of the trajectory still
+    ahead of the train is written as an animated feature, shown by the base map
+    :return: the path of the html page
+    """
+    return writeMap(tripFeatures(trajectory, currentMoment))
 
 
+def tripFeatures(trajectory, currentMoment):
+    """
+    :return: the list of the animated feature of the part of a trajectory still ahead of the train
+    """
+    points = relevantPoints(trajectory, currentMoment)
+    return [compactFeature(points, localOffset(currentMoment))]
 
 
-def meanDelays(station1, station2, epoch, epochStart, epochEnd):
+def trainFeatures(trips, trajectories, epochStart, epochEnd):
+    """
+    Creates one moving LineString feature per trip, restricted to the nodes between two times,
+    plus the nodes just before and after them so that the trains enter and leave the map
+    :param trips: rows of the station table of each trip
+    :param trajectories: structured arrays returned by osm.retrieveTrajectories
+    :return: the list of features
     """
-    Retreive the mean time delay for each stop in a trip by:
-        - querying the database for stations 1 & 2 in input
-        - get the common trip id of both station
-        - Retreive the mean delay for the given trip
+    offset = localOffset(epochStart)
+    features = []
+    for trip, trajectory in zip(trips, trajectories):
+        inside = (trajectory['t'] >= epochStart) & (trajectory['t'] <= epochEnd)
+        keep = inside.copy()
+        keep[:-1] |= inside[1:]
+        keep[1:] |= inside[:-1]
+        points = trajectory[keep]
+        if len(points) >= 2:
+            features.append(compactFeature(points, offset, trip[0][1] + " - " + trip[-1][1]))
+    return features
+
+
+def liveFeatures(osmdata, epochStart, epochEnd):
+    """
+    Creates the features of every train running between two times. The trips are read with a
+    single query and their trajectories built together, see osm.retrieveTrajectories.
     """
-    conn = psycopg2.connect(database="traindb", user="postgres", password="password", host="localhost", port="5432")
-    departureStation = retrieveDepartureStation(conn, station1, epoch)
-    arrivalStation = retrieveArrivalStation(conn, station2, epoch)
+    trips = storage.getBackend().activeTrips(epochStart, epochEnd)
+    trajectories = osm.retrieveTrajectories(trips, osmdata)
+    return trainFeatures(trips, trajectories, epochStart, epochEnd)
 
-    validArrivalStation, validDepartureStation = retrieveStations(arrivalStation, departureStation)
-    if len(validArrivalStation) == 0 or len(validDepartureStation) == 0:
+
+def retrieveInDb(station1, station2, epoch):
+    """
+    :return: the stops of the next trip from station1 to station2 after epoch, or an empty list
+    """
+    trips = storage.getBackend().findTrips(station1, station2, epoch, limit=1)
+    if len(trips) == 0:
         return []
-    if validDepartureStation[0][0][-1] == validArrivalStation[0][-1]:#-1
-        tripId = validArrivalStation[0][-2] #-1
-        value = retrieveMean(conn, tripId, epochStart, epochEnd)
-        conn.close()
-        return value
+    return trips[0]
+
 
+def meanDelays(station1, station2, epoch, epochStart, epochEnd):
+    """
+    Retreive the delay statistics for each stop in a trip by:
+        - finding the next trip from station 1 to station 2
+        - Reading the precomputed statistics of the trips with the same stops
+    :return: rows of (station, mean, p50, p90, max delay in minutes, number of stops)
+    """
+    trip = retrieveInDb(station1, station2, epoch)
+    if len(trip) == 0:
+        return []
+    tripId = trip[0][5]
+    return storage.getBackend().retrieveDelayStats(tripId, epochStart, epochEnd)
 
 
 class gtfsData:
-    def __init__(self, osmdata, travel):
+    def __init__(self, osmdata, travel, step=None, render=True):
+        """
+        :param travel: [departure station, arrival station, epoch]
+        :param step: optional callable, called with a message before each stage of the search
+        :param render: write the map page of the trajectory, see visualizeTrains
+        """
+        if step:
+            step("Searching the next trip")
         trip = retrieveInDb(travel[0], travel[1], travel[2])
+        self.trip = trip
         if len(trip) == 0:
             self.found = False
         else:
             self.found = True
             startTime = trip[0][4]
-            endTime = trip[-1][4]
-            osm.retrieveTripCoordinates(startTime, trip, osmdata)
-            self.file = visualizeTrains(travel[2])
+            if step:
+                step("Computing the trajectory")
+            self.trajectory = osm.retrieveTripCoordinates(startTime, trip, osmdata)
+            if render:
+                if step:
+                    step("Rendering the map")
+                self.file = visualizeTrains(self.trajectory, travel[2])